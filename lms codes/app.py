@@ -1,12 +1,28 @@
+import io
 import os
+import re
+import csv
 import sys
+import gzip
 import json
+import time
+import zlib
+import shutil
+import hashlib
+import posixpath
+import mimetypes
+import threading
 from datetime import datetime, timedelta
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from bson import ObjectId
-from pymongo import MongoClient
+from pymongo import MongoClient, IndexModel, ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, PyMongoError
+import click
 from dotenv import load_dotenv
 from werkzeug.security import generate_password_hash, check_password_hash
-from flask import Flask, request, render_template, redirect, url_for, flash, session
+from flask.json.provider import DefaultJSONProvider
+from flask import Flask, request, render_template, stream_template, redirect, url_for, flash, get_flashed_messages, session, jsonify, g, abort, send_from_directory
 
 
 ### Load environment variables from .env file ###
@@ -21,17 +37,1301 @@ app.secret_key = os.getenv("FLASK_APP_SECRET").encode()
 app.config['SESSION_COOKIE_SECURE'] = True
 app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=1)
+app.config['CATALOG_PAGE_SIZE'] = int(os.getenv("CATALOG_PAGE_SIZE", 25))
+app.config['CATALOG_MAX_PAGE_SIZE'] = int(os.getenv("CATALOG_MAX_PAGE_SIZE", 100))
+app.config['STREAM_BATCH_SIZE'] = int(os.getenv("STREAM_BATCH_SIZE", 100))
+app.config['SEARCH_CANDIDATES'] = int(os.getenv("SEARCH_CANDIDATES", 1000)) # matches scored per search
+app.config['HASH_WORKERS'] = int(os.getenv("HASH_WORKERS", 2)) # 0 hashes inline on the request thread
+app.config['HASH_QUEUE_SIZE'] = int(os.getenv("HASH_QUEUE_SIZE", 8))
+app.config['HASH_TIMEOUT'] = float(os.getenv("HASH_TIMEOUT", 10))
+app.config['HASH_RETRY_AFTER'] = int(os.getenv("HASH_RETRY_AFTER", 2)) # Seconds a refused sign-in is told to wait
+app.config['PROFILE_CACHE_SIZE'] = int(os.getenv("PROFILE_CACHE_SIZE", 1024))
+app.config['PROFILE_CACHE_TTL'] = float(os.getenv("PROFILE_CACHE_TTL", 300))
+app.config['METRICS_ENABLED'] = os.getenv("METRICS_ENABLED", "1") == "1"
+app.config['CATALOG_VERSION_TTL'] = float(os.getenv("CATALOG_VERSION_TTL", 1))
+app.config['CATALOG_VERSION_BUS_TTL'] = float(os.getenv("CATALOG_VERSION_BUS_TTL", 60)) # while the invalidation bus is connected
+app.config['INVALIDATION_BUS'] = os.getenv("INVALIDATION_BUS", "0") == "1" # needs a replica set (change streams)
+app.config['INVALIDATION_TOKEN_SAVE_INTERVAL'] = float(os.getenv("INVALIDATION_TOKEN_SAVE_INTERVAL", 5))
+app.config['FINE_PER_DAY'] = float(os.getenv("FINE_PER_DAY", 1))
+app.config['COMPRESS_MIN_SIZE'] = int(os.getenv("COMPRESS_MIN_SIZE", 1024))
+app.config['COMPRESS_MIMETYPES'] = ("text/html", "text/plain", "application/json")
+app.config['MONGODB_MAX_POOL_SIZE'] = int(os.getenv("MONGODB_MAX_POOL_SIZE", 100))
+app.config['MONGODB_MIN_POOL_SIZE'] = int(os.getenv("MONGODB_MIN_POOL_SIZE", 0))
+app.config['MONGODB_WAIT_QUEUE_TIMEOUT_MS'] = int(os.getenv("MONGODB_WAIT_QUEUE_TIMEOUT_MS", 2000))
+app.config['MONGODB_SERVER_SELECTION_TIMEOUT_MS'] = int(os.getenv("MONGODB_SERVER_SELECTION_TIMEOUT_MS", 5000))
+app.config['MONGODB_CONNECT_TIMEOUT_MS'] = int(os.getenv("MONGODB_CONNECT_TIMEOUT_MS", 5000))
+app.config['MONGODB_SOCKET_TIMEOUT_MS'] = int(os.getenv("MONGODB_SOCKET_TIMEOUT_MS", 30000))
+
+
+### JSON SERIALIZATION ###
+
+# Documents are serialized straight from MongoDB: ObjectIds as strings and dates as ISO 8601.
+# orjson is used when installed (optional), the standard library otherwise.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+class MongoJSONProvider(DefaultJSONProvider):
+    sort_keys = False
+    compact = True
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, ObjectId):
+            return str(o)
+        if isinstance(o, datetime):
+            return o.isoformat()
+        return DefaultJSONProvider.default(o)
+
+    def dumps(self, obj, **kwargs):
+        if orjson and not kwargs:
+            return orjson.dumps(obj, default=self.default, option=orjson.OPT_PASSTHROUGH_DATETIME).decode()
+        return super().dumps(obj, **kwargs)
+
+    def response(self, *args, **kwargs):
+        # jsonify goes through here and always passes formatting kwargs, which orjson has no use for
+        if not orjson:
+            return super().response(*args, **kwargs)
+        return self._app.response_class(self.dumps(self._prepare_response_obj(args, kwargs)), mimetype=self.mimetype)
+
+app.json = MongoJSONProvider(app)
+
+# Templates render document ids with str(...)
+app.add_template_global(str, "str")
+
+
+### INSTRUMENTATION ###
+
+class Histogram:
+    """Labelled latency histogram rendered in the Prometheus text exposition format."""
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help, labels):
+        self.name, self.help, self.labels = name, help, labels
+        self._series = dict()
+        self._lock = threading.Lock()
+
+    def observe(self, label_values, seconds):
+        with self._lock:
+            series = self._series.setdefault(label_values, dict(buckets=[0] * len(self.BUCKETS), sum=0.0, count=0))
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    series["buckets"][i] += 1
+            series["sum"] += seconds
+            series["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_values, series in self._series.items():
+                counts, total, count = series["buckets"], series["sum"], series["count"]
+                labels = ",".join(f'{k}="{v}"' for k, v in zip(self.labels, label_values))
+                for bound, n in zip(self.BUCKETS, counts):
+                    lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {n}')
+                lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {count}')
+                lines.append(f"{self.name}_sum{{{labels}}} {total}")
+                lines.append(f"{self.name}_count{{{labels}}} {count}")
+        return lines
+
+request_latency = Histogram("lms_request_duration_seconds", "Flask request latency by route.", ("route", "method", "status"))
+mongo_latency = Histogram("lms_mongodb_command_duration_seconds", "MongoDB command latency by collection and operation.",
+    ("collection", "operation", "outcome"))
+
+class CommandMetrics(monitoring.CommandListener):
+    """Times every MongoDB command issued by the driver, by collection and operation."""
+
+    def __init__(self):
+        self._collections = dict()
+
+    def started(self, event):
+        target = event.command.get(event.command_name)
+        self._collections[(event.request_id, event.connection_id)] = target if isinstance(target, str) else ""
+
+    def _finished(self, event, outcome):
+        collection = self._collections.pop((event.request_id, event.connection_id), "")
+        mongo_latency.observe((collection, event.command_name, outcome), event.duration_micros / 1e6)
+
+    def succeeded(self, event):
+        self._finished(event, "success")
+
+    def failed(self, event):
+        self._finished(event, "failure")
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Counts connection pool events and tracks connections currently checked out."""
+
+    EVENTS = ("created", "closed", "checked_out", "checked_in", "check_out_failed", "cleared")
+
+    def __init__(self):
+        self.counts = dict.fromkeys(self.EVENTS, 0)
+        self.in_use = 0
+        self._lock = threading.Lock()
+
+    def _count(self, event_name, in_use=0):
+        with self._lock:
+            self.counts[event_name] += 1
+            self.in_use += in_use
+
+    def connection_created(self, event):
+        self._count("created")
+
+    def connection_closed(self, event):
+        self._count("closed")
+
+    def connection_checked_out(self, event):
+        self._count("checked_out", 1)
+
+    def connection_checked_in(self, event):
+        self._count("checked_in", -1)
+
+    def connection_check_out_failed(self, event):
+        self._count("check_out_failed")
+
+    def pool_cleared(self, event):
+        self._count("cleared")
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def render(self):
+        with self._lock:
+            lines = ["# HELP lms_mongodb_pool_events_total MongoDB connection pool events.",
+                "# TYPE lms_mongodb_pool_events_total counter"]
+            lines += [f'lms_mongodb_pool_events_total{{event="{k}"}} {v}' for k, v in self.counts.items()]
+            lines += ["# HELP lms_mongodb_pool_connections_in_use Connections currently checked out of the pool.",
+                "# TYPE lms_mongodb_pool_connections_in_use gauge", f"lms_mongodb_pool_connections_in_use {self.in_use}"]
+        return lines
+
+command_metrics, pool_metrics = CommandMetrics(), PoolMetrics()
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    if app.config['METRICS_ENABLED'] and "request_started" in g:
+        route = request.url_rule.rule if request.url_rule else "<unmatched>"
+        request_latency.observe((route, request.method, str(response.status_code)), time.perf_counter() - g.request_started)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    if not app.config['METRICS_ENABLED']:
+        abort(404)
+
+    lines = request_latency.render() + mongo_latency.render() + pool_metrics.render()
+    lines += ["# HELP lms_profile_cache_operations_total Profile cache lookups by outcome.",
+        "# TYPE lms_profile_cache_operations_total counter"]
+    stats = profile_cache.stats()
+    lines += [f'lms_profile_cache_operations_total{{outcome="hit"}} {stats["hits"]}',
+        f'lms_profile_cache_operations_total{{outcome="miss"}} {stats["misses"]}']
+    bus = invalidation_bus.stats()
+    lines += ["# HELP lms_invalidation_bus_connected Whether the cache invalidation change stream is open.",
+        "# TYPE lms_invalidation_bus_connected gauge", f"lms_invalidation_bus_connected {int(bus['connected'])}",
+        "# HELP lms_invalidation_bus_events_total Change events applied to the in-process caches.",
+        "# TYPE lms_invalidation_bus_events_total counter", f"lms_invalidation_bus_events_total {bus['events']}"]
+    return "\n".join(lines) + "\n", 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+### STATIC ASSETS & COMPRESSION ###
+
+# `flask --app app build-assets` copies every static file to static/dist/ under a content-hashed
+# name, next to precompressed .gz (and .br, when the optional brotli package is installed)
+# variants, and records the mapping in static/dist/manifest.json. Stylesheets are built last,
+# with their relative url(...) references rewritten to the hashed names. Templates link assets
+# with asset_url(), and the hashed files are served with immutable cache headers.
+ASSETS_DIR = "dist"
+ASSET_ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+_asset_manifest = dict(mtime=None, paths=dict())
+
+def rewrite_css_urls(css, relpath, manifest):
+    folder = posixpath.dirname(relpath)
+
+    def rewrite(match):
+        quote, url = match.groups()
+        if re.match(r"[a-z][a-z0-9+.-]*:|//|#", url, re.I): # data:, https:, protocol-relative or fragment only
+            return match.group(0)
+        path, suffix = re.match(r"([^?#]*)(.*)", url.strip()).groups()
+        target = posixpath.normpath(path[1:] if path.startswith("/") else posixpath.join(folder, path))
+        if target not in manifest:
+            return match.group(0)
+        return f"url({quote}{posixpath.relpath(manifest[target], folder or '.')}{suffix}{quote})"
+    return CSS_URL.sub(rewrite, css)
+
+def build_assets():
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+
+    static_folder = app.static_folder
+    if not static_folder or not os.path.isdir(static_folder):
+        return dict()
+    dist_folder = os.path.join(static_folder, ASSETS_DIR)
+    shutil.rmtree(dist_folder, ignore_errors=True)
+    sources = list()
+    for root, dirs, files in os.walk(static_folder):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != dist_folder]
+        sources += [os.path.relpath(os.path.join(root, filename), static_folder).replace(os.sep, "/") for filename in files]
+
+    manifest = dict()
+    for relpath in sorted(sources, key=lambda relpath: (relpath.endswith(".css"), relpath)):
+        with open(os.path.join(static_folder, relpath), "rb") as fhand:
+            content = fhand.read()
+        if relpath.endswith(".css"):
+            content = rewrite_css_urls(content.decode("utf-8"), relpath, manifest).encode("utf-8")
+        stem, ext = os.path.splitext(relpath)
+        hashed = f"{stem}.{hashlib.sha256(content).hexdigest()[:12]}{ext}"
+        target = os.path.join(dist_folder, hashed)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, "wb") as fhand:
+            fhand.write(content)
+        with open(target + ".gz", "wb") as fhand:
+            fhand.write(gzip.compress(content, compresslevel=9, mtime=0))
+        if brotli:
+            with open(target + ".br", "wb") as fhand:
+                fhand.write(brotli.compress(content, quality=11))
+        manifest[relpath] = hashed
+
+    with open(os.path.join(dist_folder, "manifest.json"), "w") as fhand:
+        json.dump(manifest, fhand, indent=2, sort_keys=True)
+    return manifest
+
+def asset_manifest():
+    path = os.path.join(app.static_folder, ASSETS_DIR, "manifest.json")
+    mtime = os.path.getmtime(path) if os.path.exists(path) else None
+    if mtime != _asset_manifest["mtime"]:
+        paths = dict()
+        if mtime is not None:
+            with open(path) as fhand:
+                paths = json.load(fhand)
+        _asset_manifest.update(mtime=mtime, paths=paths)
+    return _asset_manifest["paths"]
+
+@app.template_global()
+def asset_url(filename):
+    # Falls back to the plain static file until the assets are built
+    hashed = asset_manifest().get(filename)
+    if hashed is None:
+        return url_for('static', filename=filename)
+    return url_for('static_asset', filename=hashed)
+
+@app.route(f'/{ASSETS_DIR}/<path:filename>', methods=['GET'])
+def static_asset(filename):
+    directory = os.path.join(app.static_folder, ASSETS_DIR)
+    mimetype = None
+    for encoding, suffix in ASSET_ENCODINGS:
+        if encoding in request.accept_encodings and os.path.isfile(os.path.join(directory, filename + suffix)):
+            response = send_from_directory(directory, filename + suffix, mimetype=mimetypes.guess_type(filename)[0],
+                max_age=31536000)
+            response.content_encoding = encoding
+            break
+    else:
+        response = send_from_directory(directory, filename, max_age=31536000)
+    response.vary.add("Accept-Encoding")
+    response.cache_control.immutable = True
+    return response
+
+def gzip_stream(chunks):
+    # Flushes after every chunk, so a streamed page still reaches the client as it renders
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        if data := compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH):
+            yield data
+    yield compressor.flush()
+
+@app.after_request
+def compress_response(response):
+    if (response.status_code != 200 or response.direct_passthrough or response.content_encoding
+            or response.mimetype not in app.config['COMPRESS_MIMETYPES'] or "gzip" not in request.accept_encodings):
+        return response
+
+    response.vary.add("Accept-Encoding")
+    if response.is_streamed:
+        response.response = gzip_stream(response.iter_encoded())
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < app.config['COMPRESS_MIN_SIZE']:
+            return response
+        response.set_data(gzip.compress(data, compresslevel=6))
+    response.content_encoding = "gzip"
+    return response
 
 
 ### DATABASE CONNECTION ###
 
-client = MongoClient(os.getenv('MONGODB_URI'))
-db = client['library_management_system']
+# The client is created on first use in each process rather than at import, and again in a
+# forked child (e.g. gunicorn workers forked after import), since a MongoClient is not fork-safe.
+# With MONGODB_MIN_POOL_SIZE set, the driver warms the pool up in the background once created.
+_client_lock = threading.Lock()
+_client, _client_pid = None, None
+
+def get_client():
+    global _client, _client_pid
+    if _client_pid != os.getpid():
+        with _client_lock:
+            if _client_pid != os.getpid():
+                _client = MongoClient(os.getenv('MONGODB_URI'), **client_options())
+                _client_pid = os.getpid()
+    return _client
+
+def client_options():
+    # Shared by the async client of the ASGI mode (asgi.py)
+    return dict(
+        maxPoolSize=app.config['MONGODB_MAX_POOL_SIZE'],
+        minPoolSize=app.config['MONGODB_MIN_POOL_SIZE'],
+        waitQueueTimeoutMS=app.config['MONGODB_WAIT_QUEUE_TIMEOUT_MS'],
+        serverSelectionTimeoutMS=app.config['MONGODB_SERVER_SELECTION_TIMEOUT_MS'],
+        connectTimeoutMS=app.config['MONGODB_CONNECT_TIMEOUT_MS'],
+        socketTimeoutMS=app.config['MONGODB_SOCKET_TIMEOUT_MS'],
+        event_listeners=[command_metrics, pool_metrics] if app.config['METRICS_ENABLED'] else [])
+
+def database_name():
+    return os.getenv('MONGODB_DATABASE', 'library_management_system')
+
+# $dateDiff (FINES) needs MongoDB 5.0
+MIN_SERVER_VERSION = (5, 0)
+
+def check_server_version():
+    version = tuple(get_client().server_info()["versionArray"][:2])
+    if version < MIN_SERVER_VERSION:
+        raise RuntimeError(f"MongoDB {'.'.join(map(str, MIN_SERVER_VERSION))}+ is required, the server runs {'.'.join(map(str, version))}")
+
+def get_db():
+    return get_client()[database_name()]
+
+class Lazy:
+    """Stands in for a database/collection, resolving it on the current process' client at each use."""
+
+    def __init__(self, resolve):
+        self._resolve = resolve
+
+    def __getattr__(self, attr):
+        return getattr(self._resolve(), attr)
+
+    def __getitem__(self, key):
+        return self._resolve()[key]
+
+db = Lazy(get_db)
+
+librarians = Lazy(lambda: get_db()['librarians'])
+patrons = Lazy(lambda: get_db()['patrons'])
+books = Lazy(lambda: get_db()['books'])
+bookings = Lazy(lambda: get_db()['bookings'])
+migrations = Lazy(lambda: get_db()['migrations'])
+jobs = Lazy(lambda: get_db()['jobs'])
+counters = Lazy(lambda: get_db()['counters'])
+rollups = Lazy(lambda: get_db()['rollups'])
+
+
+### PASSWORD HASHING ###
+
+# Hashing runs in a per-process pool of HASH_WORKERS processes. At most HASH_QUEUE_SIZE hashes
+# may be queued or running; further logins fail fast instead of holding request threads, so a
+# login burst cannot starve the catalog routes of threads or CPU.
+_hash_lock = threading.Lock()
+_hash_pool, _hash_slots, _hash_pid = None, None, None
+
+def hash_pool():
+    global _hash_pool, _hash_slots, _hash_pid
+    with _hash_lock:
+        if _hash_pid != os.getpid(): # (Re)create after a fork, the parent's pool is unusable
+            _hash_pool = ProcessPoolExecutor(max_workers=app.config['HASH_WORKERS'])
+            _hash_slots = threading.BoundedSemaphore(app.config['HASH_QUEUE_SIZE'])
+            _hash_pid = os.getpid()
+        return _hash_pool, _hash_slots
+
+def run_hashing(fn, *args):
+    if app.config['HASH_WORKERS'] <= 0:
+        return fn(*args)
+
+    pool, slots = hash_pool()
+    if not slots.acquire(blocking=False):
+        raise TimeoutError("The password hashing queue is full")
+    try:
+        future = pool.submit(fn, *args)
+    except Exception:
+        slots.release()
+        raise
+    future.add_done_callback(lambda _: slots.release())
+    return future.result(timeout=app.config['HASH_TIMEOUT'])
+
+hash_password = lambda password: run_hashing(generate_password_hash, password, os.getenv('HASH_METHOD'))
+verify_password = lambda pwhash, password: run_hashing(check_password_hash, pwhash, password)
+
+def hashing_busy(template):
+    # The form is served again with a 503 so the client can tell a busy server from a refused sign-in
+    flash("Too many sign-ins in progress! Please re-try in a moment.", "warning")
+    return render_template(template), 503, {"Retry-After": str(app.config['HASH_RETRY_AFTER'])}
+
+
+### PROFILE CACHE ###
+
+class LRUCache:
+    """Thread-safe in-process LRU cache whose entries also expire after <ttl> seconds.
+
+    Every invalidation bumps a generation counter. A value loaded before an invalidation
+    (put with the generation read before loading it) may be stale and is not cached.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize, self.ttl = maxsize, ttl
+        self.hits = self.misses = 0
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def generation(self):
+        with self._lock:
+            return self._generation
+
+    def get(self, key, loader):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self._generation
+        value = loader()
+        if value is not None:
+            self.put(key, value, generation)
+        return value
+
+    def put(self, key, value, generation=None):
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, size=len(self._entries))
+
+profile_cache = LRUCache(app.config['PROFILE_CACHE_SIZE'], app.config['PROFILE_CACHE_TTL'])
+
+def profile_collection(role):
+    return {"librarian": librarians, "patron": patrons}[role]
+
+def get_profile(role, user_id):
+    return profile_cache.get((role, user_id),
+        lambda: profile_collection(role).find_one(dict(_id=ObjectId(user_id)), {"password": 0}))
+
+def update_profile(role, user_id, fields):
+    # Write-through: the updated document replaces the cached one in the same round trip
+    generation = profile_cache.generation()
+    profile = profile_collection(role).find_one_and_update({"_id": ObjectId(user_id)}, {"$set": fields},
+        projection={"password": 0}, return_document=ReturnDocument.AFTER)
+    if profile:
+        profile_cache.put((role, user_id), profile, generation)
+    else:
+        profile_cache.invalidate((role, user_id))
+    return profile
+
+
+### INDEXES ###
+
+# Declared indexes per collection, unique where the routes already assume one document per key
+INDEX_SPEC = {
+    "librarians": [
+        dict(keys=[("email", 1)], unique=True)
+    ],
+    "patrons": [
+        dict(keys=[("email", 1)], unique=True)
+    ],
+    "books": [
+        dict(keys=[("title", 1)], unique=True),
+        dict(keys=[("book_cover_url", 1)], unique=True),
+        dict(keys=[("available", 1)]),
+        dict(keys=[("keywords", 1)])
+    ],
+    "bookings": [
+        dict(keys=[("book_id", 1), ("type", 1), ("checkin_date", 1), ("checkout_date", 1)]),
+        dict(keys=[("type", 1), ("checkin_date", 1)]),
+        dict(keys=[("type", 1), ("checkout_date", 1)]),
+        dict(keys=[("checkin_date", 1)]),
+        dict(keys=[("patron_id", 1), ("_id", 1)]),
+        dict(keys=[("patron_name", 1), ("_id", 1)])
+    ],
+    "rollups": [
+        dict(keys=[("kind", 1), ("day", 1)]),
+        dict(keys=[("kind", 1), ("borrows", -1)])
+    ]
+}
+
+def ensure_indexes():
+    # create_indexes is a no-op for indexes that already exist with the same options,
+    # and raises if an existing index (or duplicate data) contradicts the spec
+    for name, specs in INDEX_SPEC.items():
+        db[name].create_indexes([IndexModel(**spec) for spec in specs])
+
+def hot_queries():
+    # (collection, filter, sort) of the queries issued by the routes and jobs, with sample values
+    sample_id, today = ObjectId(), datetime.today()
+    return [
+        ("librarians", {"email": ""}, None),
+        ("patrons", {"email": ""}, None),
+        ("books", {"title": ""}, None),
+        ("books", {"book_cover_url": ""}, None),
+        ("books", {"available": True}, None),
+        ("books", search_query(["sample", "qu"]), None),
+        ("books", dict(), [("_id", 1)]),
+        ("books", {"available": True}, [("_id", 1)]),
+        ("books", claim_query(sample_id, today, today), None),
+        ("bookings", {"book_id": sample_id, "type": "borrow"}, None),
+        ("bookings", {"type": "reserve", "$and": [booking_date_filter("checkin_date", gte=today), booking_date_filter("checkin_date", lte=today)]}, None),
+        ("bookings", {"type": "borrow"}, None),
+        ("bookings", {"book_id": sample_id, "type": "reserve", **booking_date_filter("checkout_date", gte=today)}, [("checkin_date", 1)]),
+        ("bookings", {"patron_id": sample_id}, None),
+        ("bookings", {"patron_name": ""}, [("_id", 1)]),
+        ("bookings", {"$and": [booking_date_filter("checkin_date", gte=today), booking_date_filter("checkin_date", lte=today)]}, [("_id", 1)]),
+        ("bookings", overdue_filter(today), [("_id", 1)]),
+        ("rollups", {"kind": "day", "day": {"$gte": today}}, [("day", 1)]),
+        ("rollups", {"kind": "book"}, [("borrows", -1)]),
+        ("bookings", overdue_filter(today), None)
+    ]
+
+def plan_stages(plan):
+    yield plan.get("stage")
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            yield from plan_stages(plan[key])
+    for child in plan.get("inputStages", list()):
+        yield from plan_stages(child)
+
+def verify_query_plans():
+    collscans = list()
+    for name, query, sort in hot_queries():
+        cursor = db[name].find(query).limit(1)
+        if sort:
+            cursor = cursor.sort(sort)
+        if "COLLSCAN" in plan_stages(cursor.explain()["queryPlanner"]["winningPlan"]):
+            collscans.append(f"{name}.find({query})")
+    if collscans:
+        raise RuntimeError("Query plan(s) falling back to COLLSCAN: " + "; ".join(collscans))
+
+
+### CATALOG VERSION ###
+
+# Version of what the catalog pages show, "<counter>.<book count>.<newest book _id>". Edits, deletes
+# and availability changes bump the counter; inserts are not counted, since a new book already
+# changes the book count and the newest book _id, so adding a book stays a single write. Each
+# process keeps the last version it saw for CATALOG_VERSION_TTL seconds, so a revalidated page is
+# answered with 304 Not Modified without querying MongoDB or rendering. Every write expires it in
+# the writing process; other processes see the change via the invalidation bus or the TTL.
+_catalog_lock = threading.Lock()
+_catalog_version = dict(version=None, updated_at=None, expires=0.0, generation=0)
+
+def catalog_generation():
+    with _catalog_lock:
+        return _catalog_version["generation"]
+
+def catalog_state():
+    # (counter, newest book, book count) the catalog version is derived from
+    return (counters.find_one({"_id": "catalog"}) or dict(), books.find_one(dict(), {"_id": 1}, sort=[("_id", -1)]),
+        books.estimated_document_count())
+
+def remember_catalog_version(state, generation):
+    # A version read before an invalidation arrived (<generation> moved on) is returned but not kept
+    doc, newest, count = state
+    updated_at = doc.get("updated_at", datetime(1970, 1, 1))
+    if newest:
+        updated_at = max(updated_at, newest["_id"].generation_time.replace(tzinfo=None))
+    with _catalog_lock:
+        ttl = app.config['CATALOG_VERSION_BUS_TTL'] if invalidation_bus.connected else app.config['CATALOG_VERSION_TTL']
+        _catalog_version.update(version=f"{doc.get('version', 0)}.{count}.{newest['_id'] if newest else ''}",
+            updated_at=updated_at, expires=time.monotonic() + ttl if generation == _catalog_version["generation"] else 0.0)
+        return dict(_catalog_version)
+
+def expire_catalog_version():
+    with _catalog_lock:
+        _catalog_version.update(expires=0.0, generation=_catalog_version["generation"] + 1)
+
+def cached_catalog_version():
+    with _catalog_lock:
+        if _catalog_version["expires"] > time.monotonic():
+            return dict(_catalog_version)
+    return None
+
+def catalog_version():
+    if version := cached_catalog_version():
+        return version
+    generation = catalog_generation()
+    return remember_catalog_version(catalog_state(), generation)
+
+def bump_catalog_version():
+    # Not needed after an insert (see above), which only calls expire_catalog_version()
+    counters.update_one({"_id": "catalog"}, {"$inc": {"version": 1}, "$currentDate": {"updated_at": True}}, upsert=True)
+    expire_catalog_version()
+
+def catalog_validators(version):
+    # The page also shows the user and, for paginated views, depends on the query string
+    etag = hashlib.sha1(f"{version['version']}|{session.get('user_id')}|{session.get('user_name')}|{request.full_path}"
+        .encode()).hexdigest()
+    last_modified = version["updated_at"].replace(microsecond=0)
+
+    not_modified = request.if_none_match.contains(etag) if request.if_none_match else \
+        bool(request.if_modified_since and last_modified <= request.if_modified_since.replace(tzinfo=None))
+    return etag, last_modified, not_modified
+
+def catalog_response(render, version=None):
+    # Pending flash messages are part of the page, so such a response is always rendered fresh
+    if "_flashes" in session:
+        return render()
+
+    etag, last_modified, not_modified = catalog_validators(version or catalog_version())
+    response = app.response_class(status=304) if not_modified else app.make_response(render())
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+### CACHE INVALIDATION BUS ###
+
+# With INVALIDATION_BUS on, every process tails one change stream over the cached collections
+# and drops the affected keys from its own caches, so a write handled by one gunicorn worker
+# reaches the others' caches within moments rather than after their TTLs. The resume token is
+# saved in `jobs`, so a restarted or reconnected stream picks up where it left off. While the
+# stream is down the caches are flushed once and then fall back to plain TTL expiry.
+INVALIDATION_COLLECTIONS = ("books", "bookings", "counters", "librarians", "patrons")
+CHANGE_STREAM_HISTORY_LOST = (280, 286) # ChangeStreamFatalError, ChangeStreamHistoryLost
+
+class InvalidationBus:
+    """Per-process change stream consumer that invalidates the in-process caches."""
+
+    def __init__(self):
+        self.connected = False
+        self.events = self.reconnects = 0
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        # Threads do not survive a fork, so each gunicorn worker starts its own
+        with self._lock:
+            if self._pid != os.getpid():
+                threading.Thread(target=self.run, name="invalidation-bus", daemon=True).start()
+                self._pid = os.getpid()
+
+    def stats(self):
+        with self._lock:
+            return dict(connected=self.connected, events=self.events, reconnects=self.reconnects)
+
+    def apply(self, change):
+        with self._lock:
+            self.events += 1
+        collection, key = change.get("ns", dict()).get("coll"), change.get("documentKey", dict()).get("_id")
+        if key is None: # drop, rename or invalidate: no telling which keys changed
+            self.flush()
+        elif collection in ("librarians", "patrons"):
+            profile_cache.invalidate((collection[:-1], str(key)))
+        else:
+            expire_catalog_version()
+
+    def flush(self):
+        profile_cache.clear()
+        expire_catalog_version()
+
+    def save_token(self, token):
+        jobs.update_one({"_id": "invalidation_bus"}, {"$set": {"resume_token": token, "saved_at": datetime.utcnow()}}, upsert=True)
+
+    def run(self):
+        # The resume token lives in this thread only. It is saved every INVALIDATION_TOKEN_SAVE_INTERVAL
+        # seconds and once more when the stream drops, so neither a reconnect nor a restart loses it.
+        token, saved, delay = None, None, 1
+        while True:
+            try:
+                if token is None:
+                    token = saved = (jobs.find_one({"_id": "invalidation_bus"}, {"resume_token": 1}) or dict()).get("resume_token")
+                pipeline = [{"$match": {"ns.coll": {"$in": list(INVALIDATION_COLLECTIONS)}}}]
+                with db.watch(pipeline, resume_after=token, max_await_time_ms=1000) as stream:
+                    with self._lock:
+                        self.connected = True
+                    saved_at = time.monotonic()
+                    print(f"[EVENT LOG]: Invalidation bus connected (pid {os.getpid()})")
+                    while stream.alive:
+                        if change := stream.try_next():
+                            self.apply(change)
+                        delay = 1 # Back off again only once the stream has worked, not merely opened
+                        token = stream.resume_token or token
+                        if token != saved and time.monotonic() - saved_at > app.config['INVALIDATION_TOKEN_SAVE_INTERVAL']:
+                            self.save_token(token)
+                            saved, saved_at = token, time.monotonic()
+            except OperationFailure as ex:
+                print(f"[ERROR]: Invalidation bus stream failed: {ex}", file=sys.stderr)
+                if ex.code in CHANGE_STREAM_HISTORY_LOST:
+                    # The token fell off the oplog: the missed events are lost, so restart from now
+                    token = saved = None
+                    try:
+                        jobs.update_one({"_id": "invalidation_bus"}, {"$unset": {"resume_token": ""}})
+                    except PyMongoError:
+                        pass # The saved token fails the same way next time and is dropped then
+            except PyMongoError as ex:
+                print(f"[ERROR]: Invalidation bus disconnected: {ex}", file=sys.stderr)
+            except Exception as ex: # Anything else (a malformed event, a bug) must not kill the thread for good
+                print(f"[ERROR]: Invalidation bus crashed: {ex!r}", file=sys.stderr)
+            finally:
+                # However the stream ended, /metrics must not keep reporting it connected
+                with self._lock:
+                    dropped, self.connected = self.connected, False
+                    self.reconnects += int(dropped)
+
+            if token is not None and token != saved:
+                try:
+                    self.save_token(token)
+                    saved = token
+                except PyMongoError:
+                    pass # Kept in memory: the next connection resumes from it all the same
+
+            if dropped:
+                self.flush()
+            time.sleep(delay)
+            delay = min(delay * 2, 60)
+
+invalidation_bus = InvalidationBus()
+
+@app.before_request
+def start_invalidation_bus():
+    if app.config['INVALIDATION_BUS']:
+        invalidation_bus.start()
+
+
+### AVAILABILITY INDEX ###
+
+def refresh_book_availability(book_id, released_booking_id=None):
+    # A book is available again only once no other borrow booking holds it. The claim of the
+    # booking just returned or dropped (see BOOK CLAIMS) is released in the same update.
+    available = bookings.find_one({"book_id": book_id, "type": "borrow"}, {"_id": 1}) is None
+    update = {"$set": {"available": available}}
+    if released_booking_id is not None:
+        update["$pull"] = {"claims": {"booking_id": released_booking_id}}
+    book = books.find_one_and_update({"_id": book_id}, update, projection={"available": 1})
+    if book and book.get("available") != available:
+        bump_catalog_version()
+
+def rebuild_availability():
+    borrowed_book_ids = bookings.distinct("book_id", {"type": "borrow"})
+    released = books.update_many({"_id": {"$nin": borrowed_book_ids}, "available": {"$ne": True}},
+        {"$set": {"available": True}})
+    held = books.update_many({"_id": {"$in": borrowed_book_ids}, "available": {"$ne": False}},
+        {"$set": {"available": False}})
+    bump_catalog_version()
+    return released.modified_count, held.modified_count
+
+
+### BOOKING DATES ###
+
+# Bookings store <checkin_date>/<checkout_date> as native dates (midnight). Bookings written
+# before `migrate-booking-dates` ran still hold '%Y-%m-%d' strings, so date filters match
+# both forms until BOOKING_DATE_STRINGS is switched off once the migration has finished.
+BOOKING_DATE_STRINGS = os.getenv("BOOKING_DATE_STRINGS", "1") == "1"
+
+def to_booking_date(value):
+    if isinstance(value, str):
+        return datetime.strptime(value, "%Y-%m-%d")
+    return datetime(value.year, value.month, value.day)
+
+def booking_date_filter(field, **ops):
+    native = {field: {f"${op}": to_booking_date(value) for op, value in ops.items()}}
+    if not BOOKING_DATE_STRINGS:
+        return native
+    legacy = {field: {f"${op}": to_booking_date(value).strftime('%Y-%m-%d') for op, value in ops.items()}}
+    return {"$or": [native, legacy]}
+
+def booking_date_expr(field):
+    # Aggregation expression reading <field> as a native date whichever form it is stored in
+    return {"$cond": [{"$eq": [{"$type": f"${field}"}, "string"]},
+        {"$dateFromString": {"dateString": f"${field}", "format": "%Y-%m-%d"}}, f"${field}"]}
+
+@app.template_filter("booking_date")
+def format_booking_date(value):
+    return to_booking_date(value).strftime('%Y-%m-%d')
+
+def migrate_booking_dates(batch_size=1000, pause=0.0, progress=None):
+    # Resumable: the last converted <_id> is checkpointed after every batch. Each update is
+    # conditional on the string values it read, so a booking renewed mid-batch is left alone
+    # and picked up again by the final sweep from the start of the collection.
+    state = migrations.find_one({"_id": "booking_dates"}) or dict()
+    last_id = state.get("last_id")
+    pending = {"$or": [{"checkin_date": {"$type": "string"}}, {"checkout_date": {"$type": "string"}}]}
+
+    while True:
+        query = dict(pending, _id={"$gt": last_id}) if last_id else pending
+        batch = list(bookings.find(query, {"checkin_date": 1, "checkout_date": 1}).sort("_id", 1).limit(batch_size))
+        if not batch:
+            if last_id is None or bookings.find_one(pending, {"_id": 1}) is None:
+                break
+            last_id = None
+            continue
+
+        result = bookings.bulk_write([UpdateOne(
+            {"_id": b["_id"], "checkin_date": b["checkin_date"], "checkout_date": b["checkout_date"]},
+            {"$set": {"checkin_date": to_booking_date(b["checkin_date"]), "checkout_date": to_booking_date(b["checkout_date"])}}
+        ) for b in batch], ordered=False)
+
+        last_id = batch[-1]["_id"]
+        state = migrations.find_one_and_update({"_id": "booking_dates"},
+            {"$set": {"last_id": last_id, "updated_at": datetime.utcnow()}, "$inc": {"converted": result.modified_count}},
+            upsert=True, return_document=ReturnDocument.AFTER)
+        if progress:
+            progress(state["converted"])
+        if pause:
+            time.sleep(pause)
+
+    migrations.update_one({"_id": "booking_dates"},
+        {"$set": {"last_id": None, "finished_at": datetime.utcnow()}}, upsert=True)
+    return (state or dict()).get("converted", 0)
+
+
+### BOOK CLAIMS ###
+
+# Every booking holds a claim on its book: a {booking_id, checkin, checkout} window kept in the
+# book's <claims>. Borrowing, reserving and renewing test for overlapping claims and add or move
+# their own in one conditional find_one_and_update on the book, so of two concurrent bookings
+# of a book only one can win, while bookings of different books never contend. The booking
+# itself is written once its claim is won. `rebuild-claims` derives the claims from the bookings.
+def claim_overlap(start, end, exclude_booking_id=None):
+    window = {"checkin": {"$lte": end}, "checkout": {"$gte": start}}
+    if exclude_booking_id is not None:
+        window["booking_id"] = {"$ne": exclude_booking_id}
+    return {"claims": {"$elemMatch": window}}
+
+def claim_query(book_id, start, end):
+    # An _id lookup, so only the claims of this one book are ever examined
+    return {"_id": book_id, "$nor": [claim_overlap(start, end)]}
+
+def claim_book(book_id, booking_id, start, end, borrow=False):
+    # Returns the book snapshot when the claim is won; a borrow also takes the book off the shelf
+    query = claim_query(book_id, start, end)
+    update = {"$push": {"claims": dict(booking_id=booking_id, checkin=start, checkout=end)}}
+    if borrow:
+        query["available"] = {"$ne": False}
+        update["$set"] = {"available": False}
+    return books.find_one_and_update(query, update, projection=BOOK_SNAPSHOT_FIELDS)
+
+def extend_claim(book_id, booking_id, end):
+    # Moves the claim's checkout out to <end> unless another claim overlaps [its checkin, end];
+    # returns the claim as it was, to move it back should the booking update fail
+    own = {"$arrayElemAt": [{"$filter": {"input": "$claims", "as": "c", "cond": {"$eq": ["$$c.booking_id", booking_id]}}}, 0]}
+    overlap = {"$anyElementTrue": [{"$map": {"input": "$claims", "as": "c", "in": {"$and": [
+        {"$ne": ["$$c.booking_id", booking_id]}, {"$lte": ["$$c.checkin", end]}, {"$gte": ["$$c.checkout", "$$own.checkin"]}]}}}]}
+    book = books.find_one_and_update(
+        {"_id": book_id, "claims": {"$elemMatch": {"booking_id": booking_id, "checkout": {"$lte": end}}},
+            "$expr": {"$let": {"vars": {"own": own}, "in": {"$not": [overlap]}}}},
+        {"$set": {"claims.$[claim].checkout": end}}, array_filters=[{"claim.booking_id": booking_id}],
+        projection={"claims": {"$elemMatch": {"booking_id": booking_id}}})
+    return book["claims"][0] if book else None
+
+def move_claim(book_id, booking_id, checkout):
+    books.update_one({"_id": book_id}, {"$set": {"claims.$[claim].checkout": checkout}},
+        array_filters=[{"claim.booking_id": booking_id}])
+
+def release_claim(book_id, booking_id):
+    books.update_one({"_id": book_id}, {"$pull": {"claims": {"booking_id": booking_id}}})
+
+def restore_claim(book_id, booking, end):
+    # Claims [checkin, end] for a booking made before `rebuild-claims` ran, if no other claim
+    # overlaps it; returns the claim as the booking had it
+    start = to_booking_date(booking["checkin_date"])
+    if claim_book(book_id, booking["_id"], start, end):
+        return dict(booking_id=booking["_id"], checkin=start, checkout=to_booking_date(booking["checkout_date"]))
+    return None
+
+def claim_conflict(book_id, start, end, exclude_booking_id=None):
+    # Only read once a claim was refused, to tell the patron why: returns (book, overlapping claim)
+    book = books.find_one({"_id": book_id}, {"available": 1, "claims": 1})
+    for claim in (book or dict()).get("claims", list()):
+        if claim["booking_id"] != exclude_booking_id and claim["checkin"] <= end and claim["checkout"] >= start:
+            return book, claim
+    return book, None
+
+def renewal_conflict(book_id, booking_id, end):
+    # Only read once an extension was refused: returns (own claim, claim overlapping [own checkin, end]);
+    # no own claim means the booking predates `rebuild-claims`
+    claims = (books.find_one({"_id": book_id}, {"claims": 1}) or dict()).get("claims", list())
+    own = next((claim for claim in claims if claim["booking_id"] == booking_id), None)
+    if own is None:
+        return None, None
+    return own, next((claim for claim in claims if claim["booking_id"] != booking_id
+        and claim["checkin"] <= end and claim["checkout"] >= own["checkin"]), None)
+
+def rebuild_claims():
+    # Resets every book's claims, then groups the bookings per book and merges them in server-side
+    books.update_many({"claims": {"$ne": []}}, {"$set": {"claims": []}})
+    bookings.aggregate([
+        {"$group": {"_id": "$book_id", "claims": {"$push": {"booking_id": "$_id",
+            "checkin": booking_date_expr("checkin_date"), "checkout": booking_date_expr("checkout_date")}}}},
+        {"$merge": {"into": books.name, "on": "_id", "whenMatched": "merge", "whenNotMatched": "discard"}}
+    ])
+    return books.count_documents({"claims.0": {"$exists": True}})
+
+
+### FINES ###
+
+# Overdue days and fines are stored on the borrow bookings. The nightly job recomputes every
+# overdue borrow in one server-side pipeline update, renewals and returns settle the single
+# booking they touch. The stored values are as of the last such write, so the pages showing
+# or charging a fine recompute it for today from the checkout date. A renewal carries the fine
+# accrued so far in <fine_carried>, payments accumulate in <fine_paid>, and the unpaid fine of
+# a returned book moves to the patron.
+FINE_FIELDS = {"type": 1, "checkout_date": 1, "fine_carried": 1, "fine": 1, "fine_paid": 1}
+
+def overdue_days_expr(today):
+    return {"$max": [0, {"$dateDiff": {"startDate": booking_date_expr("checkout_date"), "endDate": today, "unit": "day"}}]}
+
+def fine_expr(overdue_days):
+    return {"$add": [{"$ifNull": ["$fine_carried", 0]}, {"$multiply": [overdue_days, app.config['FINE_PER_DAY']]}]}
+
+def fine_stages(today):
+    return [{"$set": {"overdue_days": overdue_days_expr(today)}}, {"$set": {"fine": fine_expr("$overdue_days")}}]
+
+def overdue_filter(today):
+    # Borrows past their checkout date, on the (type, checkout_date) index; renewed ones were reset on renewal
+    return {"type": "borrow", **booking_date_filter("checkout_date", lt=today)}
+
+def update_fines(today):
+    return bookings.update_many(overdue_filter(today), fine_stages(today))
+
+def booking_fine(booking, today):
+    if booking.get("type") != "borrow":
+        return 0, booking.get("fine", 0)
+    overdue_days = max(0, (today - to_booking_date(booking["checkout_date"])).days)
+    return overdue_days, booking.get("fine_carried", 0) + overdue_days * app.config['FINE_PER_DAY']
+
+def with_fines(rows, today):
+    # Brings the stored <overdue_days>/<fine> of each booking up to <today>
+    for booking in rows:
+        booking["overdue_days"], booking["fine"] = booking_fine(booking, today)
+    return rows
+
+fine_due = lambda booking, today: max(0, booking_fine(booking, today)[1] - booking.get("fine_paid", 0))
+
+
+### CATALOG SEARCH ###
+
+# Every book carries <keywords>: the lowercased tokens of its title, author and genre on a
+# multikey index. Complete query terms are matched exactly and the last (still being typed)
+# term as an anchored prefix, which a text index cannot do. Matches are ranked server-side,
+# before the limit, by where the terms hit: title over author over genre, whole words over
+# prefixes, then by title. Scoring costs a few regexes per match, so at most SEARCH_CANDIDATES
+# matches (in index order) are scored: only a very broad query, like a one-letter prefix, can
+# miss a better match beyond them (see benchmarks/search.py).
+SEARCH_WEIGHTS = {"title": 3, "author": 2, "genre": 1}
+SEARCH_FIELDS = {"book_cover_url": 1, "title": 1, "author": 1, "genre": 1, "published": 1, "available": 1}
+
+tokenize = lambda text: re.findall(r"\w+", str(text).lower())
+
+# Word boundaries for the server-side regexes. PCRE's \b only knows ASCII words, while <tokenize>
+# splits on Unicode ones, so "émile" would never score as a whole word; this is Python's \w.
+SEARCH_WORD_CHAR = r"[\p{L}\p{N}_]"
+
+def search_keywords(title, author, genre):
+    return sorted(set(tokenize(title) + tokenize(author) + tokenize(genre)))
+
+def search_query(terms):
+    *words, prefix = terms
+    return {"$and": [{"keywords": word} for word in words] + [{"keywords": {"$regex": f"^{re.escape(prefix)}"}}]}
+
+def search_score(terms):
+    # Aggregation expression: per field and term, twice the weight for a whole word, the weight for a prefix
+    hit = lambda field, pattern: {"$regexMatch": {"input": f"${field}", "regex": pattern, "options": "i"}}
+    start, end = f"(?<!{SEARCH_WORD_CHAR})", f"(?!{SEARCH_WORD_CHAR})"
+    return {"$add": [{"$cond": [hit(field, f"{start}{re.escape(term)}{end}"), 2 * weight,
+        {"$cond": [hit(field, f"{start}{re.escape(term)}"), weight, 0]}]} for field, weight in SEARCH_WEIGHTS.items() for term in terms]}
+
+def search_books(text, limit):
+    terms = tokenize(text)[:8]
+    if not terms:
+        return list()
+    # The sort and limit coalesce into a top-k sort, so only <limit> books are ever held
+    return list(books.aggregate([
+        {"$match": search_query(terms)},
+        {"$limit": app.config['SEARCH_CANDIDATES']},
+        {"$project": dict(SEARCH_FIELDS, score=search_score(terms))},
+        {"$sort": {"score": -1, "title": 1}},
+        {"$limit": limit},
+        {"$unset": "score"}
+    ]))
+
+def rebuild_search_keywords(batch_size=1000):
+    updated, batch = 0, list()
+    for book in books.find(dict(), {"title": 1, "author": 1, "genre": 1}):
+        batch.append(UpdateOne({"_id": book["_id"]},
+            {"$set": {"keywords": search_keywords(book.get("title", ""), book.get("author", ""), book.get("genre", ""))}}))
+        if len(batch) == batch_size:
+            updated += books.bulk_write(batch, ordered=False).modified_count
+            batch.clear()
+    if batch:
+        updated += books.bulk_write(batch, ordered=False).modified_count
+    return updated
+
+
+### BULK CATALOG IMPORT ###
+
+def read_book_rows(stream, fmt):
+    # Yields (row number, row or parsing error) from a text stream, one row at a time
+    match fmt:
+        case 'csv':
+            for line_no, row in enumerate(csv.DictReader(stream), start=2):
+                yield line_no, row
+        case 'ndjson':
+            for line_no, line in enumerate(stream, start=1):
+                if line.strip():
+                    try:
+                        yield line_no, json.loads(line)
+                    except ValueError as ex:
+                        yield line_no, ex
+        case _:
+            raise ValueError(f"Unsupported import format <{fmt}>, expected csv or ndjson")
+
+def book_from_row(row, librarian_id):
+    if isinstance(row, Exception):
+        raise row
+    title, author, genre = row["title"].strip(), row["author"].strip(), row["genre"].strip()
+    if not title:
+        raise ValueError("missing title")
+    return dict(book_cover_url=row["book_cover_url"].strip(), title=title, author=author, genre=genre,
+        published=int(row["published"]), librarian_id=librarian_id, available=True,
+        keywords=search_keywords(title, author, genre))
+
+def insert_book_batch(batch, report):
+    # Duplicate detection for the whole batch in one query, then one unordered insert_many.
+    # The unique indexes on <title>/<book_cover_url> still catch rows raced in meanwhile.
+    listed = books.find({"$or": [{"title": {"$in": [b["title"] for _, b in batch]}},
+        {"book_cover_url": {"$in": [b["book_cover_url"] for _, b in batch]}}]}, {"title": 1, "book_cover_url": 1})
+    seen_titles, seen_covers = set(), set()
+    for b in listed:
+        seen_titles.add(b["title"])
+        seen_covers.add(b["book_cover_url"])
+
+    rows = list()
+    for line_no, book in batch:
+        if book["title"] in seen_titles or book["book_cover_url"] in seen_covers:
+            report["duplicates"] += 1
+            continue
+        seen_titles.add(book["title"])
+        seen_covers.add(book["book_cover_url"])
+        rows.append((line_no, book))
+    if not rows:
+        return
+
+    try:
+        result = books.insert_many([book for _, book in rows], ordered=False)
+        report["inserted"] += len(result.inserted_ids)
+    except BulkWriteError as ex:
+        report["inserted"] += ex.details["nInserted"]
+        for error in ex.details["writeErrors"]:
+            if error["code"] == 11000: # Listed meanwhile: counted as a duplicate, not an error
+                report["duplicates"] += 1
+            else:
+                report["errors"].append(dict(row=rows[error["index"]][0], error=error["errmsg"]))
+    finally:
+        expire_catalog_version() # Even a failed batch may have inserted some of its books
+
+def import_books(rows, librarian_id, batch_size=1000, progress=None):
+    report = dict(rows=0, inserted=0, duplicates=0, errors=list())
+    batch = list()
+    for line_no, row in rows:
+        report["rows"] += 1
+        try:
+            batch.append((line_no, book_from_row(row, librarian_id)))
+        except Exception as ex:
+            report["errors"].append(dict(row=line_no, error=f"{type(ex).__name__}: {ex}"))
+        if len(batch) == batch_size:
+            insert_book_batch(batch, report)
+            batch.clear()
+            if progress:
+                progress(report)
+    if batch:
+        insert_book_batch(batch, report)
+        if progress:
+            progress(report)
+    return report
+
+import_format = lambda filename: "csv" if filename.lower().endswith(".csv") else "ndjson"
+
+
+### BOOK SNAPSHOTS ###
+
+# Bookings carry <book_details>, a snapshot of the book fields shown on the borrows and history
+# pages, written with the booking and fanned out by edit_book, so those pages need no $lookup
+BOOK_SNAPSHOT_FIELDS = {"title": 1, "author": 1, "genre": 1, "book_cover_url": 1}
+
+def book_snapshot(book):
+    return {field: book.get(field) for field in BOOK_SNAPSHOT_FIELDS}
+
+def backfill_book_snapshots():
+    # Joins the books server-side and merges the snapshots into the bookings missing one
+    bookings.aggregate([
+        {'$match': {'book_details': {'$exists': False}}},
+        {'$lookup': {'from': 'books', 'localField': 'book_id', 'foreignField': '_id',
+            'pipeline': [{'$project': {'_id': 0, **BOOK_SNAPSHOT_FIELDS}}], 'as': 'book_details'}},
+        {'$unwind': '$book_details'},
+        {'$project': {'book_details': 1}},
+        {'$merge': {'into': bookings.name, 'on': '_id', 'whenMatched': 'merge', 'whenNotMatched': 'discard'}}
+    ])
+    return bookings.count_documents({'book_details': {'$exists': False}})
+
+
+### CIRCULATION ROLLUPS ###
+
+# Circulation stats are pre-aggregated in `rollups` as the events happen: one document per day
+# ("day:YYYY-MM-DD", with per-genre and per-institution counters) and one per book ("book:<id>",
+# with its snapshot), both $inc-upserted by a single bulk write. The analytics page reads a few
+# of these documents however large `bookings` grows, and the counts outlive returned bookings.
+CIRCULATION_EVENTS = ("borrows", "reserves", "renewals", "returns", "promotions")
+
+rollup_key = lambda value: re.sub(r"[.$]", "_", str(value or "unknown"))
+
+def circulation_changes(event, booking, day, count=1):
+    # (rollup _id, update) of the day and the book an event is counted in
+    details = booking.get("book_details") or dict()
+    genre, institution = rollup_key(details.get("genre")), rollup_key(booking.get("patron_institution"))
+    book_update = {"$setOnInsert": {"kind": "book", "book_id": booking["book_id"]}, "$inc": {event: count}}
+    if details: # Keeps the latest snapshot of the book
+        book_update["$set"] = details
+    return [
+        (f"day:{day.strftime('%Y-%m-%d')}", {"$setOnInsert": {"kind": "day", "day": day},
+            "$inc": {event: count, f"genres.{genre}.{event}": count, f"institutions.{institution}.{event}": count}}),
+        (f"book:{booking['book_id']}", book_update)
+    ]
+
+def circulation_updates(event, booking, day, count=1):
+    return [UpdateOne({"_id": key}, update, upsert=True) for key, update in circulation_changes(event, booking, day, count)]
 
-librarians = db['librarians']
-patrons = db['patrons']
-books = db['books']
-bookings = db['bookings']
+def record_circulation(event, booking):
+    # The stats must never fail the write they describe
+    try:
+        rollups.bulk_write(circulation_updates(event, booking, to_booking_date(datetime.today())), ordered=False)
+    except PyMongoError as ex:
+        print(f"[ERROR]: Circulation <{event}> not recorded: {ex}", file=sys.stderr)
+
+def sum_rollups(daily, field):
+    # Adds up the per-genre or per-institution counters of the daily rollups
+    totals = defaultdict(lambda: dict.fromkeys(CIRCULATION_EVENTS, 0))
+    for day in daily:
+        for key, counts in day.get(field, dict()).items():
+            for event, n in counts.items():
+                totals[key][event] += n
+    return dict(totals)
+
+def rebuild_rollups(batch_size=1000):
+    # Backfills the day and book rollups that do not exist yet from the bookings still on file;
+    # rollups already there hold history the bookings no longer have (returns, renewals,
+    # promotions, returned loans) and are never touched. Each missing rollup is written whole
+    # with $setOnInsert, so one created meanwhile by a live event is left as it is.
+    # A promoted reservation counts as the borrow it became, on the day it was booked.
+    institutions = {p["_id"]: p.get("institution") for p in patrons.find({}, {"institution": 1})}
+    genres = {b["_id"]: b.get("genre") for b in books.find({}, {"genre": 1})}
+    counts, details = defaultdict(int), dict()
+    for booking in bookings.find({}, {"book_id": 1, "patron_id": 1, "type": 1, "book_details": 1}).batch_size(batch_size):
+        institution = institutions.get(booking.get("patron_id"))
+        snapshot = booking.get("book_details") or dict()
+        details[booking["book_id"]] = dict(snapshot, genre=genres.get(booking["book_id"], snapshot.get("genre")))
+        counts[(f"{booking['type']}s", booking["book_id"], institution, to_booking_date(booking["_id"].generation_time))] += 1
+
+    missing = dict()
+    for (event, book_id, institution, day), count in counts.items():
+        changes = circulation_changes(event, dict(book_id=book_id, patron_institution=institution,
+            book_details=details[book_id]), day, count)
+        for key, update in changes:
+            doc = missing.setdefault(key, dict())
+            doc.update(update["$setOnInsert"], **update.get("$set", dict()))
+            for path, n in update["$inc"].items():
+                *parents, leaf = path.split(".")
+                node = doc
+                for parent in parents:
+                    node = node.setdefault(parent, dict())
+                node[leaf] = node.get(leaf, 0) + n
+
+    backfilled, requests = 0, list()
+    for key, doc in missing.items():
+        requests.append(UpdateOne({"_id": key}, {"$setOnInsert": doc}, upsert=True))
+        if len(requests) == batch_size:
+            backfilled += rollups.bulk_write(requests, ordered=False).upserted_count
+            requests.clear()
+    if requests:
+        backfilled += rollups.bulk_write(requests, ordered=False).upserted_count
+    return backfilled
+
+
+### KEYSET PAGINATION ###
+
+# Fields rendered by <librarian/dashboard.html>
+CATALOG_FIELDS = {"book_cover_url": 1, "title": 1, "author": 1, "genre": 1, "published": 1, "librarian_id": 1}
+
+def requested_page_size():
+    page_size = request.args.get("limit", app.config['CATALOG_PAGE_SIZE'], type=int)
+    return max(1, min(page_size, app.config['CATALOG_MAX_PAGE_SIZE']))
+
+def requested_cursor(name):
+    # A malformed ?after=/?before= (e.g. an edited link) falls back to the first page
+    cursor = request.args.get(name)
+    return cursor if cursor and ObjectId.is_valid(cursor) else None
+
+def keyset_query(query, page_size, after=None, before=None):
+    # Seeks on the <_id> index from the cursor instead of skipping, so fetching page N costs
+    # the same as page 1. One extra document is read to know whether another page exists.
+    # Returns the (query, direction, limit) to run sorted on <_id>.
+    if before:
+        return {**query, "_id": {"$lt": ObjectId(before)}}, -1, page_size + 1
+    if after:
+        return {**query, "_id": {"$gt": ObjectId(after)}}, 1, page_size + 1
+    return query, 1, page_size + 1
+
+def keyset_rows(rows, page_size, after=None, before=None):
+    # Trims the fetched rows to the page and derives the cursors of its neighbours
+    if before:
+        has_prev = len(rows) > page_size
+        rows = rows[:page_size][::-1]
+        prev_cursor = str(rows[0]["_id"]) if rows and has_prev else None
+        next_cursor = str(rows[-1]["_id"]) if rows else None
+    else:
+        has_next = len(rows) > page_size
+        rows = rows[:page_size]
+        prev_cursor = str(rows[0]["_id"]) if rows and after else None
+        next_cursor = str(rows[-1]["_id"]) if rows and has_next else None
+    return rows, prev_cursor, next_cursor
+
+def keyset_page(fetch, query, page_size, after=None, before=None):
+    # <fetch(query, direction, limit)> runs the query sorted on <_id>
+    return keyset_rows(fetch(*keyset_query(query, page_size, after, before)), page_size, after, before)
+
+def find_page(collection, query, projection, page_size, after=None, before=None):
+    return keyset_page(lambda q, direction, limit: list(collection.find(q, projection).sort("_id", direction).limit(limit)),
+        query, page_size, after=after, before=before)
 
 
 ### COMMON ROUTES ###
@@ -81,12 +1381,13 @@ def login_user():
                         if not librarian:
                             flash(f"Please register! No record of the librarian exists.", "warning")
                             return redirect("/register")
-                        if check_password_hash(librarian['password'], _password):
+                        if verify_password(librarian['password'], _password):
                             # Initialize session
                             session["user_id"] = str(librarian["_id"])
                             session["user_name"] = librarian["name"]
                             session["user_role"] = role
                             session["user_email"] = email
+                            session["user_institution"] = librarian.get("institution")
                             flash(f"Welcome to your librarian dashboard, {librarian['name']}!", "success")
                             return redirect("/librarian/dashboard")
                         flash(f"Invalid email or password! Please re-try.", "warning")
@@ -96,12 +1397,13 @@ def login_user():
                         if not patron:
                             flash(f"Please register! No record of the patron exists.", "warning")
                             return redirect("/register")
-                        if check_password_hash(patron['password'], _password):
+                        if verify_password(patron['password'], _password):
                             # Initialize session
                             session["user_id"] = str(patron["_id"])
                             session["user_name"] = patron["name"]
                             session["user_role"] = role
                             session["user_email"] = email
+                            session["user_institution"] = patron.get("institution")
                             flash(f"Welcome to your patron dashboard, {patron['name']}!", "success")
                             return redirect("/patron/dashboard")
                         flash(f"Invalid email or password! Please re-try.", "warning")
@@ -109,6 +1411,8 @@ def login_user():
                     case _:
                         flash("Unsecure activity detected!", "error")
                         return redirect("/register")
+            except TimeoutError:
+                return hashing_busy('login.html')
             except Exception as ex:
                 flash(f"ERROR: {ex}", "error")
                 return redirect("/register")
@@ -126,29 +1430,27 @@ def register_user():
             try:
                 name = request.form['name']
                 email = request.form['email']
-                password = generate_password_hash(request.form['password'], method=os.getenv('HASH_METHOD'))
+                password = hash_password(request.form['password'])
                 phone = request.form['phone']
                 institution = request.form['institution']
                 role = request.form['role']
 
+                # The unique <email> indexes reject an already registered user in the same round trip
                 match role:
                     case 'librarian':
-                        if librarians.find_one(dict(email=email)):
-                            flash(f"Registered librarian! Please login with <{email}>", "warning")
-                            return redirect("/login")
-
                         _ = librarians.insert_one(dict(name=name, email=email, password=password,
                             phone=phone, institution=institution))
                     case 'patron':
-                        if patrons.find_one(dict(email=email)):
-                            flash(f"Registered patron! Please login with <{email}>", "warning")
-                            return redirect("/login")
-
                         _ = patrons.insert_one(dict(name=name, email=email, password=password,
                             phone=phone, institution=institution))
                     case _:
                         flash("Unsecure activity detected!", "error")
                         return redirect("/register")
+            except DuplicateKeyError:
+                flash(f"Registered {role}! Please login with <{email}>", "warning")
+                return redirect("/login")
+            except TimeoutError:
+                return hashing_busy('register.html')
             except Exception as ex:
                 flash(f"ERROR: {ex}", "error")
                 return redirect("/register")
@@ -191,6 +1493,19 @@ def user_forgot_password():
             flash("Our support team will reach out to you. Thanks for your patience!", "success")
             return redirect("/login")
 
+@app.route('/search', methods=['GET'])
+def search_catalog():
+    if "user_id" not in session or "user_email" not in session:
+        flash("Access denied! Please login to continue...", "error")
+        return redirect("/login")
+
+    query = request.args.get("q", "")
+    results = search_books(query, requested_page_size())
+    if request.args.get("format") == "json":
+        # Search-as-you-type suggestions
+        return jsonify(results=results)
+    return render_template(f"{session['user_role']}/search.html", catalog=results, query=query)
+
 @app.route('/logout', methods=['GET'])
 def logout_user():
     if "user_id" not in session or "user_email" not in session:
@@ -202,9 +1517,27 @@ def logout_user():
     session.pop("user_name", None)
     session.pop("user_role", None)
     session.pop("user_email", None)
+    session.pop("user_institution", None)
     flash("Session closed!", "info")
     return redirect("/login")
 
+@app.route('/ready', methods=['GET'])
+def readiness_probe():
+    client = get_client()
+    pool_options = client.options.pool_options
+    report = dict(pid=os.getpid(), pool=dict(max_size=pool_options.max_pool_size, min_size=pool_options.min_pool_size,
+        wait_queue_timeout=pool_options.wait_queue_timeout))
+    if app.config['METRICS_ENABLED']:
+        report["pool"].update(in_use=pool_metrics.in_use, **pool_metrics.counts)
+    try:
+        started = time.perf_counter()
+        client.admin.command("ping")
+        report.update(status="ready", ping_ms=round((time.perf_counter() - started) * 1000, 2))
+        return jsonify(report), 200
+    except Exception as ex:
+        report.update(status="unavailable", error=str(ex))
+        return jsonify(report), 503
+
 ### LIBRARIAN ROUTES ###
 
 @app.route('/librarian/dashboard', methods=['GET'])
@@ -213,7 +1546,13 @@ def librarian_dashboard():
         flash("Access denied! Please login to continue...", "error")
         return redirect("/login")
 
-    return render_template("librarian/dashboard.html", catalog=books.find(), str=str)
+    def render():
+        page_size = requested_page_size()
+        catalog, prev_cursor, next_cursor = find_page(books, dict(), CATALOG_FIELDS, page_size,
+            after=requested_cursor("after"), before=requested_cursor("before"))
+        return render_template("librarian/dashboard.html", catalog=catalog,
+            prev_cursor=prev_cursor, next_cursor=next_cursor, page_size=page_size)
+    return catalog_response(render)
 
 @app.route('/librarian/add/book', methods=['GET', 'POST'])
 def add_book():
@@ -232,26 +1571,48 @@ def add_book():
                 genre = request.form["genre"]
                 published = int(request.form["published"])
 
-                # Check if the book is already listed in the catalog
-                used_book_cover = books.find_one(dict(book_cover_url=book_cover_url))
-                used_book_title = books.find_one(dict(title=title))
-
-                warn_msg = "Book already listed! Please check the catalog."
-                if used_book_cover:
-                    warn_msg = f"Book cover already used for another book in the catalog with title <{used_book_cover['title']}>"
-
-                if used_book_cover or used_book_title:
-                    flash(warn_msg, "warning")
-                    return redirect("/librarian/dashboard")
-
+                # The unique <title>/<book_cover_url> indexes reject an already listed book
                 _book = books.insert_one(dict(book_cover_url=book_cover_url, title=title, author=author,
-                            genre=genre, published=published, librarian_id=ObjectId(session["user_id"])))
+                            genre=genre, published=published, librarian_id=ObjectId(session["user_id"]), available=True,
+                            keywords=search_keywords(title, author, genre)))
+                expire_catalog_version()
                 flash(f"New book added: {_book.inserted_id}", "success")
                 return redirect("/librarian/dashboard")
+            except DuplicateKeyError as ex:
+                warn_msg = "Book already listed! Please check the catalog."
+                if "book_cover_url" in (ex.details or dict()).get("keyValue", dict()):
+                    used_book_cover = books.find_one(dict(book_cover_url=book_cover_url), {"title": 1})
+                    warn_msg = f"Book cover already used for another book in the catalog with title <{used_book_cover['title'] if used_book_cover else title}>"
+                flash(warn_msg, "warning")
+                return redirect("/librarian/dashboard")
             except Exception as ex:
                 flash(f"Unable to add book: {ex}", "error")
                 return redirect("/librarian/dashboard")
 
+@app.route('/librarian/import/books', methods=['GET', 'POST'])
+def import_catalog():
+    if "user_id" not in session or "user_email" not in session or session["user_role"] != "librarian":
+        flash("Access denied! Please login to continue...", "error")
+        return redirect("/login")
+
+    match request.method:
+        case 'GET':
+            return render_template("librarian/import_books.html")
+        case 'POST':
+            try:
+                upload = request.files["catalog"]
+                fmt = request.form.get("format") or import_format(upload.filename)
+                report = import_books(read_book_rows(io.TextIOWrapper(upload.stream, encoding="utf-8", newline=""), fmt),
+                    ObjectId(session["user_id"]))
+                flash(f"Imported {report['inserted']} of {report['rows']} book(s), {report['duplicates']} duplicate(s), "
+                    f"{len(report['errors'])} error(s)", "success" if not report["errors"] else "warning")
+                for error in report["errors"][:10]:
+                    flash(f"Row {error['row']}: {error['error']}", "warning")
+                return redirect("/librarian/dashboard")
+            except Exception as ex:
+                flash(f"Unable to import books: {ex}", "error")
+                return redirect("/librarian/dashboard")
+
 @app.route('/librarian/edit/book/<book_id>', methods=['GET', 'POST'])
 def edit_book(book_id):
     if "user_id" not in session or "user_email" not in session or session["user_role"] != "librarian":
@@ -271,7 +1632,13 @@ def edit_book(book_id):
                 published = int(request.form["published"])
                 _book = books.update_one({"_id": ObjectId(book_id), "librarian_id": ObjectId(session["user_id"])},
                             {"$set": dict(book_cover_url=book_cover_url, title=title, author=author,
-                            genre=genre, published=published, librarian_id=ObjectId(session["user_id"]))})
+                            genre=genre, published=published, librarian_id=ObjectId(session["user_id"]),
+                            keywords=search_keywords(title, author, genre))})
+                if _book.matched_count:
+                    bump_catalog_version()
+                    # Fan the new snapshot out to the bookings of this book in one bulk update
+                    _ = bookings.update_many({"book_id": ObjectId(book_id)},
+                        {"$set": {"book_details": book_snapshot(dict(book_cover_url=book_cover_url, title=title, author=author, genre=genre))}})
                 flash(f"Book<{book_id}> updated!", "success")
                 return redirect("/librarian/dashboard")
             except Exception as ex:
@@ -286,7 +1653,8 @@ def delete_book(book_id):
         return redirect("/login")
 
     try:
-        _ = books.delete_one({"_id": ObjectId(book_id), "librarian_id": ObjectId(session["user_id"])})
+        if books.delete_one({"_id": ObjectId(book_id), "librarian_id": ObjectId(session["user_id"])}).deleted_count:
+            bump_catalog_version()
         flash(f"Book<{book_id}> deleted!", "success")
         return redirect("/librarian/dashboard")
     except Exception as ex:
@@ -299,10 +1667,26 @@ def librarian_available_books():
         flash("Access denied! Please login to continue...", "error")
         return redirect("/login")
 
-    #available_books = books.find({"book_id": {"$nin": bookings.distinct("book_id")}})
-    borrowed_book_ids = [b['book_id'] for b in bookings.find({"type": "borrow"}, {"book_id": 1, "_id": 0})]
-    available_books = books.find({"_id": {"$nin": borrowed_book_ids}})
-    return render_template("librarian/available_books.html", catalog=available_books)
+    return catalog_response(lambda: render_template("librarian/available_books.html", catalog=books.find({"available": True})))
+
+def borrows_filter(args):
+    # Builds the $match of the borrows view from ?type=, ?overdue=1, ?patron= (id or name) and ?from=/?to= (checkin)
+    clauses, filters = list(), dict()
+    if args.get("type") in ("borrow", "reserve"):
+        clauses.append({"type": filters.setdefault("type", args["type"])})
+    if args.get("overdue") == "1":
+        filters["overdue"] = True
+        clauses.append(overdue_filter(to_booking_date(datetime.today())))
+    if patron := args.get("patron", "").strip():
+        filters["patron"] = patron
+        clauses.append({"patron_id": ObjectId(patron)} if ObjectId.is_valid(patron) else {"patron_name": patron})
+    if checkin_from := args.get("from"):
+        filters["from"] = checkin_from
+        clauses.append(booking_date_filter("checkin_date", gte=datetime.strptime(checkin_from, "%Y-%m-%d")))
+    if checkin_to := args.get("to"):
+        filters["to"] = checkin_to
+        clauses.append(booking_date_filter("checkin_date", lte=datetime.strptime(checkin_to, "%Y-%m-%d")))
+    return ({"$and": clauses} if clauses else dict()), filters
 
 @app.route('/librarian/borrows', methods=['GET'])
 def book_borrows():
@@ -310,27 +1694,48 @@ def book_borrows():
         flash("Access denied! Please login to continue...", "error")
         return redirect("/login")
 
-    # Aggregation pipeline
-    pipeline = [
-        {
-            '$lookup': {
-                'from': 'books',  # collection to join
-                'localField': 'book_id',  # field from the bookings collection
-                'foreignField': '_id',  # field from the books collection
-                'as': 'book_details'  # output array field
-            }
-        },
-        {
-            '$unwind': {
-                'path': '$book_details',
-                'preserveNullAndEmptyArrays': True  # to keep bookings even if no book details are found
-            }
-        }
-    ]
-    
-    # Execute the aggregation pipeline
-    booking_details = bookings.aggregate(pipeline)
-    return render_template("librarian/borrows.html", catalog=booking_details, str=str)
+    try:
+        query, filters = borrows_filter(request.args)
+    except Exception as ex:
+        flash(f"Invalid filter: {ex}", "error")
+        return redirect("/librarian/borrows")
+
+    # Filtered and paginated on the bookings indexes; each booking carries its book snapshot
+    page_size = requested_page_size()
+    booking_details, prev_cursor, next_cursor = find_page(bookings, query, None, page_size,
+        after=requested_cursor("after"), before=requested_cursor("before"))
+    get_flashed_messages() # Pop flashes into the request now; the session cookie is sent before the body
+    return stream_template("librarian/borrows.html", catalog=booking_details, filters=filters,
+        prev_cursor=prev_cursor, next_cursor=next_cursor, page_size=page_size)
+
+@app.route('/librarian/overdue', methods=['GET'])
+def overdue_bookings():
+    if "user_id" not in session or "user_email" not in session or session["user_role"] != "librarian":
+        flash("Access denied! Please login to continue...", "error")
+        return redirect("/login")
+
+    # Borrows overdue as of today, with their fines recomputed for today
+    today = to_booking_date(datetime.today())
+    page_size = requested_page_size()
+    overdue, prev_cursor, next_cursor = find_page(bookings, overdue_filter(today), None, page_size,
+        after=requested_cursor("after"), before=requested_cursor("before"))
+    return render_template("librarian/overdue.html", catalog=with_fines(overdue, today), fine_per_day=app.config['FINE_PER_DAY'],
+        prev_cursor=prev_cursor, next_cursor=next_cursor, page_size=page_size)
+
+@app.route('/librarian/analytics', methods=['GET'])
+def circulation_analytics():
+    if "user_id" not in session or "user_email" not in session or session["user_role"] != "librarian":
+        flash("Access denied! Please login to continue...", "error")
+        return redirect("/login")
+
+    # At most <days> daily rollups and the top books, whatever the size of the bookings
+    days = max(1, min(request.args.get("days", 30, type=int), 366))
+    start = to_booking_date(datetime.today()) - timedelta(days=days - 1)
+    daily = list(rollups.find({"kind": "day", "day": {"$gte": start}}).sort("day", 1))
+    top_books = list(rollups.find({"kind": "book"}).sort("borrows", -1).limit(10))
+    totals = {event: sum(day.get(event, 0) for day in daily) for event in CIRCULATION_EVENTS}
+    return render_template("librarian/analytics.html", days=days, daily=daily, top_books=top_books, totals=totals,
+        genres=sum_rollups(daily, "genres"), institutions=sum_rollups(daily, "institutions"))
 
 @app.route('/librarian/returned/<booking_id>', methods=['GET'])
 def mark_book_returned(booking_id):
@@ -339,7 +1744,20 @@ def mark_book_returned(booking_id):
         return redirect("/login")
 
     try:
-        _ = bookings.delete_one({"_id": ObjectId(booking_id)})
+        booking = bookings.find_one_and_delete({"_id": ObjectId(booking_id)})
+        if booking and booking["type"] != "borrow":
+            release_claim(booking["book_id"], booking["_id"])
+        if booking and booking["type"] == "borrow":
+            refresh_book_availability(booking["book_id"], released_booking_id=booking["_id"])
+            record_circulation("returns", booking)
+
+            # Settle the fine as of today; whatever is left unpaid is owed by the patron
+            overdue_days, fine = booking_fine(booking, to_booking_date(datetime.today()))
+            due = max(0, fine - booking.get("fine_paid", 0))
+            if due:
+                patrons.update_one({"_id": booking["patron_id"]}, {"$inc": {"fines_due": due}})
+                profile_cache.invalidate(("patron", str(booking["patron_id"])))
+                flash(f"Returned {overdue_days} day(s) late: fine due ${due:.2f} added to the patron's account", "warning")
         flash(f"Booking marked as returned: <{booking_id}>", "success")
         return redirect("/librarian/dashboard")
     except Exception as ex:
@@ -355,15 +1773,16 @@ def librarian_profile():
 
     match request.method:
         case 'GET':
-            librarian = librarians.find_one(dict(_id=ObjectId(session["user_id"])))
+            librarian = get_profile("librarian", session["user_id"])
             return render_template("librarian/profile.html", librarian=librarian)
         case 'POST':
             try:
                 name = request.form["name"]
                 phone = request.form["phone"]
                 institution = request.form["institution"]
-                _ = librarians.update_one({"_id": ObjectId(session["user_id"])},
-                    {"$set": dict(name=name, phone=phone, institution=institution)})
+                _ = update_profile("librarian", session["user_id"], dict(name=name, phone=phone, institution=institution))
+                session["user_name"] = name
+                session["user_institution"] = institution
                 flash(f"Congratulations, {name}! Your profile updated successfully!", "success")
                 return redirect("/librarian/dashboard")
             except Exception as ex:
@@ -379,11 +1798,7 @@ def patron_dashboard():
         return redirect('/login')
 
     # Get all the available books for patron (which are not yet borrowed by others)
-    borrowed_book_ids = [b['book_id'] for b in bookings.find({"type": "borrow"}, {"book_id": 1, "_id": 0})]
-    available_books = books.find({"_id": {"$nin": borrowed_book_ids}})
-    return render_template("patron/dashboard.html", catalog=available_books, str=str)
-
-dates_overlap = lambda s1, e1, s2, e2: (s1 <= e2) and (e1 >= s2)
+    return catalog_response(lambda: render_template("patron/dashboard.html", catalog=books.find({"available": True})))
 
 @app.route('/patron/borrow/<book_id>', methods=['GET', 'POST'])
 def patron_borrow_book(book_id):
@@ -394,7 +1809,7 @@ def patron_borrow_book(book_id):
     match request.method:
         case 'GET':
             # Check bookings (not necessary, but for security reasons)
-            if book_id in set(str(b["book_id"]) for b in bookings.find({"type": "borrow"}, {"book_id": 1, "_id": 0})):
+            if bookings.find_one({"book_id": ObjectId(book_id), "type": "borrow"}, {"_id": 1}):
                 flash("Unfortunately borrowed by others. Please contact your librarian for more info!", "warning")
                 return redirect("/patron/dashboard")
             book = books.find_one(dict(_id=ObjectId(book_id)))
@@ -409,26 +1824,37 @@ def patron_borrow_book(book_id):
                     flash("Invalid checkin/checkout dates. Please refill the form!", "error")
                     return redirect(f'/patron/borrow/{book_id}')
 
-                # Check for any reservation bookings
-                reservations = list(bookings.find({"type": "reserve"}, {"book_id": 1, "checkin_date": 1, "checkout_date": 1, "_id": 0}))
-                if book_id in set(str(b["book_id"]) for b in reservations):
-                    reservations_dates = set((datetime.strptime(b["checkin_date"], "%Y-%m-%d"),
-                        datetime.strptime(b["checkout_date"], "%Y-%m-%d")) for b in reservations)
-
-                    if any(reservations_dates):
-                        for (reservation_start, reservation_end) in reservations_dates:
-                            if dates_overlap(checkin_date, checkout_date, reservation_start, reservation_end):
-                                flash(f"Already reserved from {reservation_start.strftime('%Y-%m-%d')} to {reservation_end.strftime('%Y-%m-%d')}", "warning")
-                                return redirect("/patron/dashboard")
-
-                _booking = bookings.insert_one({
+                # Claim the book for these dates: fails if it is out or any booking overlaps them
+                booking_id = ObjectId()
+                book = claim_book(ObjectId(book_id), booking_id, checkin_date, checkout_date, borrow=True)
+                if not book:
+                    book, claim = claim_conflict(ObjectId(book_id), checkin_date, checkout_date)
+                    if not book:
+                        flash(f"No record of the book <{book_id}> exists.", "error")
+                    elif claim:
+                        flash(f"Already booked from {format_booking_date(claim['checkin'])} to {format_booking_date(claim['checkout'])}", "warning")
+                    else:
+                        flash("Unfortunately borrowed by others. Please contact your librarian for more info!", "warning")
+                    return redirect("/patron/dashboard")
+
+                booking = {
+                        "_id": booking_id,
                         "book_id": ObjectId(book_id),
                         "patron_id": ObjectId(session["user_id"]),
                         "patron_name": session["user_name"],
+                        "patron_institution": session.get("user_institution"),
                         "type": "borrow",
-                        "checkin_date": checkin_date.strftime('%Y-%m-%d'),
-                        "checkout_date": checkout_date.strftime('%Y-%m-%d')
-                    })
+                        "checkin_date": checkin_date,
+                        "checkout_date": checkout_date,
+                        "book_details": book_snapshot(book)
+                    }
+                try:
+                    _booking = bookings.insert_one(booking)
+                except Exception:
+                    refresh_book_availability(ObjectId(book_id), released_booking_id=booking_id)
+                    raise
+                bump_catalog_version()
+                record_circulation("borrows", booking)
                 flash(f"Booking confirmed: {_booking.inserted_id}", "success")
                 return redirect("/patron/dashboard")
             except Exception as ex:
@@ -444,7 +1870,7 @@ def patron_reserve_book(book_id):
     match request.method:
         case 'GET':
             # Check bookings (not necessary, but for security reasons)
-            if book_id in set(str(b["book_id"]) for b in bookings.find({"type": "borrow"}, {"book_id": 1, "_id": 0})):
+            if bookings.find_one({"book_id": ObjectId(book_id), "type": "borrow"}, {"_id": 1}):
                 flash("Unfortunately borrowed by others. Please contact your librarian for more info!", "warning")
                 return redirect("/patron/dashboard")
             book = books.find_one(dict(_id=ObjectId(book_id)))
@@ -459,26 +1885,34 @@ def patron_reserve_book(book_id):
                     flash("Invalid checkin/checkout dates. Please refill the form!", "error")
                     return redirect(f'/patron/borrow/{book_id}')
 
-                # Check for any reservation bookings
-                reservations = list(bookings.find({"type": "reserve"}, {"book_id": 1, "checkin_date": 1, "checkout_date": 1, "_id": 0}))
-                if book_id in set(str(b["book_id"]) for b in reservations):
-                    reservations_dates = set((datetime.strptime(b["checkin_date"], "%Y-%m-%d"),
-                        datetime.strptime(b["checkout_date"], "%Y-%m-%d")) for b in reservations)
-
-                    if any(reservations_dates):
-                        for (reservation_start, reservation_end) in reservations_dates:
-                            if dates_overlap(checkin_date, checkout_date, reservation_start, reservation_end):
-                                flash(f"Already reserved from {reservation_start.strftime('%Y-%m-%d')} to {reservation_end.strftime('%Y-%m-%d')}", "warning")
-                                return redirect("/patron/dashboard")
-
-                _booking = bookings.insert_one({
+                # Claim the book for these dates: fails if any booking overlaps them
+                booking_id = ObjectId()
+                book = claim_book(ObjectId(book_id), booking_id, checkin_date, checkout_date)
+                if not book:
+                    book, claim = claim_conflict(ObjectId(book_id), checkin_date, checkout_date)
+                    if not book:
+                        flash(f"No record of the book <{book_id}> exists.", "error")
+                    else:
+                        flash(f"Already booked from {format_booking_date(claim['checkin'])} to {format_booking_date(claim['checkout'])}", "warning")
+                    return redirect("/patron/dashboard")
+
+                booking = {
+                        "_id": booking_id,
                         "book_id": ObjectId(book_id),
                         "patron_id": ObjectId(session["user_id"]),
                         "patron_name": session["user_name"],
+                        "patron_institution": session.get("user_institution"),
                         "type": "reserve",
-                        "checkin_date": checkin_date.strftime('%Y-%m-%d'),
-                        "checkout_date": checkout_date.strftime('%Y-%m-%d')
-                    })
+                        "checkin_date": checkin_date,
+                        "checkout_date": checkout_date,
+                        "book_details": book_snapshot(book)
+                    }
+                try:
+                    _booking = bookings.insert_one(booking)
+                except Exception:
+                    release_claim(ObjectId(book_id), booking_id)
+                    raise
+                record_circulation("reserves", booking)
                 flash(f"Booking confirmed: {_booking.inserted_id}", "success")
                 return redirect("/patron/dashboard")
             except Exception as ex:
@@ -491,32 +1925,12 @@ def patron_recent_borrows_history():
         flash("Access denied! Please login to continue...", "error")
         return redirect("/login")
 
-    # Aggregation pipeline
-    pipeline = [
-        {
-            '$match': {
-                'patron_id': ObjectId(session['user_id']) # Filters documents by patron_id
-            }
-        },
-        {
-            '$lookup': {
-                'from': 'books',  # collection to join
-                'localField': 'book_id',  # field from the bookings collection
-                'foreignField': '_id',  # field from the books collection
-                'as': 'book_details'  # output array field
-            }
-        },
-        {
-            '$unwind': {
-                'path': '$book_details',
-                'preserveNullAndEmptyArrays': True  # to keep bookings even if no book details are found
-            }
-        }
-    ]
-
-    # Execute the aggregation pipeline
-    booking_details = bookings.aggregate(pipeline)
-    return render_template("patron/history.html", catalog=booking_details, str=str, dt=datetime)
+    # Bookings of the patron on the (patron_id, _id) index, each carrying its book snapshot,
+    # streaming the page while the cursor is consumed batch by batch
+    booking_details = bookings.find({'patron_id': ObjectId(session['user_id'])}).sort('_id', 1) \
+        .batch_size(app.config['STREAM_BATCH_SIZE'])
+    get_flashed_messages() # Pop flashes into the request now; the session cookie is sent before the body
+    return stream_template("patron/history.html", catalog=booking_details, dt=datetime)
 
 @app.route('/patron/renew/<booking_id>/book/<book_id>', methods=['GET', 'POST'])
 def patron_renew_booking(booking_id, book_id):
@@ -528,55 +1942,79 @@ def patron_renew_booking(booking_id, book_id):
         case 'GET':
             booking = bookings.find_one({"_id": ObjectId(booking_id)})
             book = books.find_one({"_id": ObjectId(book_id)})
-            return render_template("patron/renew_book.html", booking=booking, book=book, str=str)
+            return render_template("patron/renew_book.html", booking=booking, book=book)
         case 'POST':
             try:
-                booking = bookings.find_one({"_id": ObjectId(booking_id)})
-                checkin_date = datetime.strptime(booking["checkin_date"], "%Y-%m-%d")
-                old_checkout_date = datetime.strptime(booking["checkout_date"], "%Y-%m-%d")
                 checkout_date = datetime.strptime(request.form["checkout_date"], "%Y-%m-%d")
-
-                # Validate <checkin_date> and <checkout_date>
-                if checkin_date > checkout_date:
+                today = to_booking_date(datetime.today())
+                if checkout_date < today:
                     flash(f"Invalid checkout date. Please refill the form!", "error")
                     return redirect(f'/patron/renew/{booking_id}/book/{book_id}')
 
-                # Check for prepone mistake
-                if old_checkout_date > checkout_date:
-                    flash(f"Preponing a renew request? Please refill the form!", "error")
+                # Extend the booking's claim on the book, unless another booking overlaps the renewed loan
+                claim = extend_claim(ObjectId(book_id), ObjectId(booking_id), checkout_date)
+                if not claim:
+                    own, conflict = renewal_conflict(ObjectId(book_id), ObjectId(booking_id), checkout_date)
+                    if own is None and (booking := bookings.find_one({"_id": ObjectId(booking_id), "book_id": ObjectId(book_id),
+                            "patron_id": ObjectId(session["user_id"])}, {"checkin_date": 1, "checkout_date": 1})):
+                        # Booked before `rebuild-claims` ran: claim the renewed loan now
+                        claim = restore_claim(ObjectId(book_id), booking, checkout_date)
+                        if not claim:
+                            book, conflict = claim_conflict(ObjectId(book_id), to_booking_date(booking["checkin_date"]), checkout_date)
+                            if not book:
+                                flash(f"No record of the book <{book_id}> exists.", "error")
+                                return redirect("/patron/history")
+                    if conflict:
+                        flash(f"Already booked from {format_booking_date(conflict['checkin'])} to {format_booking_date(conflict['checkout'])}", "warning")
+                        return redirect(f"/patron/renew/{booking_id}/book/{book_id}")
+
+                # Validate <checkin_date> and <checkout_date> in the update itself, so the booking
+                # is not read first and cannot change between the checks and the write
+                _booking = claim and bookings.find_one_and_update(
+                    {"_id": ObjectId(booking_id), "book_id": ObjectId(book_id), "patron_id": ObjectId(session["user_id"]),
+                        "$and": [booking_date_filter("checkin_date", lte=checkout_date), booking_date_filter("checkout_date", lte=checkout_date)]},
+                    # The fine accrued up to today is carried over, the new checkout date starts from zero
+                    fine_stages(today) + [{"$set": {"fine_carried": "$fine", "checkin_date": booking_date_expr("checkin_date"),
+                        "checkout_date": checkout_date}}] + fine_stages(today),
+                    projection={"book_id": 1, "patron_institution": 1, "book_details": 1}
+                )
+                if not _booking:
+                    if claim:
+                        move_claim(ObjectId(book_id), ObjectId(booking_id), claim["checkout"])
+                    booking = bookings.find_one({"_id": ObjectId(booking_id), "patron_id": ObjectId(session["user_id"])})
+                    if not booking:
+                        flash(f"No record of the booking <{booking_id}> exists.", "error")
+                        return redirect("/patron/history")
+                    if to_booking_date(booking["checkin_date"]) > checkout_date:
+                        flash(f"Invalid checkout date. Please refill the form!", "error")
+                    else:
+                        flash(f"Preponing a renew request? Please refill the form!", "error")
                     return redirect(f'/patron/renew/{booking_id}/book/{book_id}')
 
-                # Check for any reservation bookings
-                reservations = list(bookings.find({"type": "reserve"}, {"book_id": 1, "checkin_date": 1, "checkout_date": 1, "_id": 0}))
-                if book_id in set(str(b["book_id"]) for b in reservations):
-                    reservations_dates = set((datetime.strptime(b["checkin_date"], "%Y-%m-%d"),
-                        datetime.strptime(b["checkout_date"], "%Y-%m-%d")) for b in reservations)
-
-                    if any(reservations_dates):
-                        for (reservation_start, reservation_end) in reservations_dates:
-                            if dates_overlap(checkin_date, checkout_date, reservation_start, reservation_end):
-                                flash(f"Already reserved from {reservation_start.strftime('%Y-%m-%d')} to {reservation_end.strftime('%Y-%m-%d')}", "warning")
-                                return redirect(f"/patron/renew/{booking_id}/book/{book_id}")
-
-                _booking = bookings.update_one(
-                    {"_id": ObjectId(booking_id), "book_id": ObjectId(book_id)},
-                    {"$set": {"checkout_date": checkout_date.strftime('%Y-%m-%d')}}
-                )
+                record_circulation("renewals", _booking)
                 flash(f"Booking renewed: {booking_id}", "success")
                 return redirect("/patron/history")
             except Exception as ex:
                 flash(f"Unable to renew booking on this book: {ex}", "error")
                 return redirect("/patron/history")
 
+@app.route('/patron/pay_fine/<booking_id>/book/<book_id>', methods=['GET', 'POST'], defaults={"fine": None})
 @app.route('/patron/pay_fine/<fine>/<booking_id>/book/<book_id>', methods=['GET', 'POST'])
 def patron_pay_fine(fine, booking_id, book_id):
     if "user_id" not in session or "user_email" not in session or session["user_role"] != "patron":
         flash("Access denied! Please login to continue...", "error")
         return redirect("/login")
 
+    # The amount is the one stored on the booking; <fine> in the URL is kept for old links only
+    booking_filter = {"_id": ObjectId(booking_id), "patron_id": ObjectId(session["user_id"])}
     match request.method:
         case 'GET':
-            return render_template("patron/pay_fine.html", fine=fine, booking_id=booking_id, book_id=book_id)
+            today = to_booking_date(datetime.today())
+            booking = bookings.find_one(booking_filter, FINE_FIELDS)
+            if not booking or not fine_due(booking, today):
+                flash("No fine is due on this booking.", "info")
+                return redirect("/patron/history")
+            return render_template("patron/pay_fine.html", fine=f"{fine_due(booking, today):.2f}", booking_id=booking_id, book_id=book_id)
         case 'POST':
             try:
                 payment_method = request.form["payment_method"]
@@ -586,7 +2024,16 @@ def patron_pay_fine(fine, booking_id, book_id):
                 card_exp_year = int(request.form["card_exp_year"])
                 cvv = int(request.form["cvv"])
 
-                flash(f"Thank you for clearing the due fine amount: ${fine}. Please return the book immediately to avoid inconvenience to others! Keep Reading...", "success")
+                # Pays exactly what is due as of today at the time of the write, refreshing the stored fine
+                today = to_booking_date(datetime.today())
+                booking = bookings.find_one_and_update({**booking_filter, "type": "borrow",
+                        "$expr": {"$gt": [fine_expr(overdue_days_expr(today)), {"$ifNull": ["$fine_paid", 0]}]}},
+                    fine_stages(today) + [{"$set": {"fine_paid": "$fine"}}], projection=FINE_FIELDS)
+                if not booking:
+                    flash("No fine is due on this booking.", "info")
+                    return redirect("/patron/history")
+
+                flash(f"Thank you for clearing the due fine amount: ${fine_due(booking, today):.2f}. Please return the book immediately to avoid inconvenience to others! Keep Reading...", "success")
                 return redirect("/patron/history")
             except Exception as ex:
                 flash(f"Unable to pay due: {ex}", "error")
@@ -600,15 +2047,16 @@ def patron_profile():
 
     match request.method:
         case 'GET':
-            patron = patrons.find_one(dict(_id=ObjectId(session["user_id"])))
+            patron = get_profile("patron", session["user_id"])
             return render_template("patron/profile.html", patron=patron)
         case 'POST':
             try:
                 name = request.form["name"]
                 phone = request.form["phone"]
                 institution = request.form["institution"]
-                _ = patrons.update_one({"_id": ObjectId(session["user_id"])},
-                    {"$set": dict(name=name, phone=phone, institution=institution)})
+                _ = update_profile("patron", session["user_id"], dict(name=name, phone=phone, institution=institution))
+                session["user_name"] = name
+                session["user_institution"] = institution
                 flash(f"Congratulations, {name}! Your profile updated successfully!", "success")
                 return redirect("/patron/dashboard")
             except Exception as ex:
@@ -616,22 +2064,224 @@ def patron_profile():
                 return redirect("/patron/dashboard")
 
 
+### JSON API ###
+
+# Versioned JSON counterparts of the catalog and booking pages for kiosk and mobile clients.
+# They share the session login and role checks of the HTML routes, but answer 401/403 in JSON.
+API_PREFIX = "/api/v1"
+API_BOOK_FIELDS = {**CATALOG_FIELDS, "available": 1}
+API_BOOKING_FIELDS = {"book_id": 1, "type": 1, "checkin_date": 1, "checkout_date": 1, "book_details": 1, "overdue_days": 1,
+    "fine": 1, "fine_paid": 1}
+
+def api_error(status, message):
+    response = jsonify(error=message)
+    response.status_code = status
+    return response
+
+def api_denied(*roles):
+    if "user_id" not in session or "user_email" not in session:
+        return api_error(401, "Login required.")
+    if roles and session["user_role"] not in roles:
+        return api_error(403, "Access denied.")
+    return None
+
+def api_projection(allowed):
+    # ?fields=title,author narrows the documents down to the fields the client renders
+    fields = [f for f in request.args.get("fields", "").split(",") if f]
+    unknown = set(fields) - set(allowed)
+    if unknown:
+        abort(api_error(400, f"Unknown field(s): {', '.join(sorted(unknown))}"))
+    return {f: 1 for f in fields} if fields else allowed
+
+def api_cursor(name):
+    cursor = request.args.get(name)
+    if cursor and not ObjectId.is_valid(cursor):
+        abort(api_error(400, f"Invalid <{name}> cursor."))
+    return cursor
+
+def api_dates(booking):
+    for field in ("checkin_date", "checkout_date"):
+        if field in booking:
+            booking[field] = to_booking_date(booking[field])
+    return booking
+
+@app.route(f'{API_PREFIX}/books', methods=['GET'])
+def api_books():
+    if denied := api_denied():
+        return denied
+
+    query = dict()
+    if "available" in request.args:
+        query["available"] = request.args.get("available") in ("1", "true")
+    projection, page_size = api_projection(API_BOOK_FIELDS), requested_page_size()
+    after, before = api_cursor("after"), api_cursor("before")
+
+    def render():
+        catalog, prev_cursor, next_cursor = find_page(books, query, projection, page_size, after=after, before=before)
+        return jsonify(books=catalog, prev_cursor=prev_cursor, next_cursor=next_cursor)
+    return catalog_response(render)
+
+@app.route(f'{API_PREFIX}/books/<book_id>/availability', methods=['GET'])
+def api_book_availability(book_id):
+    if denied := api_denied():
+        return denied
+    if not ObjectId.is_valid(book_id):
+        return api_error(404, "No such book.")
+
+    book = books.find_one({"_id": ObjectId(book_id)}, {"available": 1})
+    if not book:
+        return api_error(404, "No such book.")
+
+    # Both lookups run on the (book_id, type, checkin_date, checkout_date) index, which also gives
+    # the reservations in checkin order, so the limit keeps the earliest upcoming ones
+    today = to_booking_date(datetime.today())
+    borrow = bookings.find_one({"book_id": book["_id"], "type": "borrow"}, {"checkout_date": 1, "_id": 0})
+    reservations = bookings.find({"book_id": book["_id"], "type": "reserve", **booking_date_filter("checkout_date", gte=today)},
+        {"checkin_date": 1, "checkout_date": 1, "_id": 0}).sort("checkin_date", 1).limit(app.config['CATALOG_PAGE_SIZE'])
+    return jsonify(book_id=book["_id"], available=book.get("available", True),
+        borrowed_until=to_booking_date(borrow["checkout_date"]) if borrow else None,
+        reservations=[api_dates(r) for r in reservations])
+
+@app.route(f'{API_PREFIX}/patron/bookings', methods=['GET'])
+def api_patron_bookings():
+    if denied := api_denied("patron"):
+        return denied
+
+    catalog, prev_cursor, next_cursor = find_page(bookings, {"patron_id": ObjectId(session["user_id"])},
+        api_projection(API_BOOKING_FIELDS), requested_page_size(), after=api_cursor("after"), before=api_cursor("before"))
+    return jsonify(bookings=[api_dates(b) for b in catalog], prev_cursor=prev_cursor, next_cursor=next_cursor)
+
+
 ### SCHEDULED JOBS ###
 
 
 def _reservations_filter_():
-    reservations = list(bookings.find({"type": "reserve"}, {"checkin_date": 1}))
-    today = datetime.today().date()
-    booking_ids = set(b['_id'] for b in reservations if datetime.strptime(b["checkin_date"], "%Y-%m-%d").date() == today)
-
-    results = list()
-    for booking_id in booking_ids:
-        results.append(bookings.update_one({"_id": booking_id}, {"$set": {"type": "borrow"}}))
+    # Promotes every reservation due since the last successful run (the watermark) in one
+    # server-side update_many on the (type, checkin_date) index, so missed days catch up at once.
+    # The watermark day itself is included again: a reservation starting on it may have been made
+    # after that run. Only reservations match, so promoting them twice is a no-op.
+    started = time.perf_counter()
+    today = to_booking_date(datetime.today())
+    state = jobs.find_one({"_id": "reservations_filter"}) or dict()
+    watermark = state.get("watermark", today)
+    window = {"$and": [booking_date_filter("checkin_date", gte=watermark), booking_date_filter("checkin_date", lte=today)]}
+
+    # Reservations about to be promoted, counted per book and institution for the rollups
+    promotions = list(bookings.aggregate([{"$match": {"type": "reserve", **window}},
+        {"$group": {"_id": {"book_id": "$book_id", "patron_institution": "$patron_institution"}, "count": {"$sum": 1},
+            "book_details": {"$last": "$book_details"}}}]))
+    promoted = bookings.update_many({"type": "reserve", **window}, {"$set": {"type": "borrow"}})
+    if promotions:
+        try: # As in record_circulation, the stats must not stop the job
+            rollups.bulk_write([update for p in promotions for update in circulation_updates("promotions",
+                dict(p["_id"], book_details=p["book_details"]), today, p["count"])], ordered=False)
+        except PyMongoError as ex:
+            print(f"[ERROR]: Circulation <promotions> not recorded: {ex}", file=sys.stderr)
+
+    # Promoted reservations now hold their books (borrows in the window already do)
+    held = books.update_many({"_id": {"$in": bookings.distinct("book_id", {"type": "borrow", **window})}, "available": {"$ne": False}},
+        {"$set": {"available": False}})
+
+    if promoted.modified_count or held.modified_count:
+        bump_catalog_version()
+
+    # Overdue days and fines of every outstanding borrow, including the ones just promoted
+    fines = update_fines(today)
+
+    stats = dict(ran_at=datetime.utcnow(), window_start=watermark, window_end=today, promoted=promoted.modified_count,
+        books_held=held.modified_count, overdue=fines.matched_count, duration_ms=round((time.perf_counter() - started) * 1000, 2))
+    jobs.update_one({"_id": "reservations_filter"}, {"$set": {"watermark": today, "last_run": stats}}, upsert=True)
 
     log_filename = f"reservations_watchdog_{today.strftime('%Y_%m_%d')}.log"
     with open(file=log_filename, mode="a") as log_fhand:
-        log_fhand.write("\n".join(map(lambda x: f"{x}", results)) + "\n")
-    print(f"[EVENT LOG]: Reservations filtered! Result(s) logged at: {log_filename}")
+        log_fhand.write(json.dumps(stats, default=str) + "\n")
+    print(f"[EVENT LOG]: Reservations filtered! {stats['promoted']} promoted, {stats['books_held']} book(s) held, "
+        f"{stats['overdue']} overdue in {stats['duration_ms']}ms. Result(s) logged at: {log_filename}")
+
+
+### CLI COMMANDS ###
+
+@app.cli.command("rebuild-availability")
+def rebuild_availability_command():
+    """Rebuild the <available> flag of every book from the borrow bookings."""
+    ensure_indexes()
+    released, held = rebuild_availability()
+    print(f"[EVENT LOG]: Availability rebuilt! {released} book(s) released, {held} book(s) held")
+
+@app.cli.command("rebuild-claims")
+def rebuild_claims_command():
+    """Rebuild the booking <claims> of every book from the bookings."""
+    claimed = rebuild_claims()
+    print(f"[EVENT LOG]: Claims rebuilt! {claimed} book(s) hold at least one claim")
+
+@app.cli.command("rebuild-search-keywords")
+def rebuild_search_keywords_command():
+    """Recompute the search <keywords> of every book in the catalog."""
+    updated = rebuild_search_keywords()
+    print(f"[EVENT LOG]: Search keywords rebuilt! {updated} book(s) updated")
+
+@app.cli.command("import-books")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--librarian-email", required=True, help="Librarian the imported books are listed under.")
+@click.option("--format", "fmt", type=click.Choice(["csv", "ndjson"]), help="Defaults from the file extension.")
+@click.option("--batch-size", default=1000, show_default=True, help="Books written per insert_many.")
+def import_books_command(path, librarian_email, fmt, batch_size):
+    """Bulk import books from a CSV or NDJSON file."""
+    librarian = librarians.find_one(dict(email=librarian_email), {"_id": 1})
+    if not librarian:
+        raise click.ClickException(f"No record of the librarian <{librarian_email}> exists.")
+
+    started = time.perf_counter()
+    with open(path, encoding="utf-8", newline="") as fhand:
+        report = import_books(read_book_rows(fhand, fmt or import_format(path)), librarian["_id"], batch_size=batch_size,
+            progress=lambda r: print(f"[EVENT LOG]: {r['rows']} row(s) read, {r['inserted']} inserted...", end="\r"))
+
+    for error in report["errors"]:
+        print(f"[ERROR]: Row {error['row']}: {error['error']}", file=sys.stderr)
+    elapsed = time.perf_counter() - started
+    print(f"\n[EVENT LOG]: Imported {report['inserted']} of {report['rows']} book(s) in {elapsed:.1f}s "
+        f"({report['inserted'] / max(elapsed, 1e-9) * 60:.0f}/min), {report['duplicates']} duplicate(s), {len(report['errors'])} error(s)")
+
+@app.cli.command("backfill-book-snapshots")
+def backfill_book_snapshots_command():
+    """Write the book snapshot onto every booking created before snapshots existed."""
+    missing = backfill_book_snapshots()
+    print(f"[EVENT LOG]: Book snapshots backfilled! {missing} booking(s) left without one (book deleted)")
+
+@app.cli.command("rebuild-rollups")
+@click.option("--batch-size", default=1000, show_default=True, help="Rollup updates per bulk write.")
+def rebuild_rollups_command(batch_size):
+    """Backfill the day and book circulation rollups missing, from the bookings on file."""
+    backfilled = rebuild_rollups(batch_size=batch_size)
+    print(f"[EVENT LOG]: Rollups backfilled! {backfilled} missing day/book rollup(s) written")
+
+@app.cli.command("build-assets")
+def build_assets_command():
+    """Fingerprint the static assets and write their precompressed variants."""
+    manifest = build_assets()
+    print(f"[EVENT LOG]: Assets built! {len(manifest)} file(s) fingerprinted into static/{ASSETS_DIR}/")
+
+@app.cli.command("indexes")
+@click.option("--verify/--no-verify", default=True, show_default=True, help="Explain the hot queries after creating the indexes.")
+def indexes_command(verify):
+    """Create the declared indexes and check that no hot query runs a COLLSCAN."""
+    ensure_indexes()
+    print(f"[EVENT LOG]: Indexes ensured on: {', '.join(INDEX_SPEC)}")
+    if verify:
+        try:
+            verify_query_plans()
+        except RuntimeError as ex:
+            raise click.ClickException(str(ex))
+        print(f"[EVENT LOG]: Query plans verified! {len(hot_queries())} hot queries use an index")
+
+@app.cli.command("migrate-booking-dates")
+@click.option("--batch-size", default=1000, show_default=True, help="Bookings converted per bulk write.")
+@click.option("--pause", default=0.05, show_default=True, help="Seconds to sleep between batches.")
+def migrate_booking_dates_command(batch_size, pause):
+    """Convert '%Y-%m-%d' booking dates to native dates, in place and resumably."""
+    converted = migrate_booking_dates(batch_size=batch_size, pause=pause,
+        progress=lambda n: print(f"[EVENT LOG]: {n} booking(s) converted so far...", end="\r"))
+    print(f"\n[EVENT LOG]: Booking dates migrated! {converted} booking(s) converted in total")
 
 
 if __name__ == "__main__":
@@ -641,6 +2291,9 @@ if __name__ == "__main__":
     from sys import stderr, exit
     from apscheduler.schedulers.background import BackgroundScheduler
 
+    check_server_version()
+    ensure_indexes()
+    verify_query_plans() # FAIL LOUDLY IF ANY ROUTE WOULD SCAN A WHOLE COLLECTION
     _reservations_filter_() # RUN ON STARTUP (IN CASE OF ANY CRASHES)
 
     try:
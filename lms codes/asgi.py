@@ -0,0 +1,243 @@
+"""
+Optional ASGI serving mode.
+
+The read-heavy GET routes (catalog pages, borrows, history, profiles and the borrow/reserve
+forms) run as coroutines on an AsyncMongoClient, so a worker keeps serving other requests
+while it waits on MongoDB instead of parking a thread per request. Every other route, and
+every non-GET request, is handed to the unchanged Flask app through asgiref's WsgiToAsgi.
+The async views run inside a regular Flask request context, so sessions, flashes, the
+before/after request hooks (metrics, compression) and templates behave exactly as in app.py.
+
+Needs pymongo >= 4.13, asgiref and an ASGI server:
+    pip install asgiref uvicorn
+    uvicorn asgi:app --workers 4
+"""
+import io
+import os
+import sys
+import asyncio
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import AsyncMongoClient
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.exceptions import HTTPException
+from flask import request, render_template, redirect, flash, session
+
+import app as lms
+
+
+### ASYNC DATABASE CONNECTION ###
+
+# Created on first use in each worker process, with the same pool settings as the sync client
+_client, _client_pid = None, None
+
+def get_db():
+    global _client, _client_pid
+    if _client_pid != os.getpid():
+        _client = AsyncMongoClient(os.getenv('MONGODB_URI'), **lms.client_options())
+        _client_pid = os.getpid()
+    return _client[lms.database_name()]
+
+
+### HELPERS ###
+
+def access_denied(role):
+    if "user_id" not in session or "user_email" not in session or session["user_role"] != role:
+        flash("Access denied! Please login to continue...", "error")
+        return redirect("/login")
+    return None
+
+async def catalog_version():
+    if version := lms.cached_catalog_version():
+        return version
+    generation = lms.catalog_generation()
+    doc, newest, count = await asyncio.gather(get_db()["counters"].find_one({"_id": "catalog"}),
+        get_db()["books"].find_one(dict(), {"_id": 1}, sort=[("_id", -1)]), get_db()["books"].estimated_document_count())
+    return lms.remember_catalog_version((doc or dict(), newest, count), generation)
+
+async def catalog_page(render, fetch):
+    # Same validators as lms.catalog_response, but a revalidation is answered before any book is read
+    version = None
+    if "_flashes" not in session:
+        version = await catalog_version()
+        if lms.catalog_validators(version)[2]:
+            return lms.catalog_response(None, version)
+    catalog = await fetch()
+    return lms.catalog_response(lambda: render(catalog), version)
+
+async def get_profile(role, user_id):
+    generation = lms.profile_cache.generation()
+    profile = lms.profile_cache.get((role, user_id), lambda: None)
+    if profile is None:
+        profile = await get_db()[f"{role}s"].find_one({"_id": ObjectId(user_id)}, {"password": 0})
+        if profile:
+            lms.profile_cache.put((role, user_id), profile, generation)
+    return profile
+
+async def borrow_and_book(book_id):
+    # The borrow check and the book lookup are independent, so both are in flight at once
+    return await asyncio.gather(
+        get_db()["bookings"].find_one({"book_id": ObjectId(book_id), "type": "borrow"}, {"_id": 1}),
+        get_db()["books"].find_one({"_id": ObjectId(book_id)}))
+
+
+### ASYNC ROUTES (GET only, keyed by the Flask endpoint they replace) ###
+
+async def librarian_available_books():
+    if denied := access_denied("librarian"):
+        return denied
+
+    return await catalog_page(lambda catalog: render_template("librarian/available_books.html", catalog=catalog),
+        lambda: get_db()["books"].find({"available": True}).to_list())
+
+async def book_borrows():
+    if denied := access_denied("librarian"):
+        return denied
+
+    try:
+        query, filters = lms.borrows_filter(request.args)
+    except Exception as ex:
+        flash(f"Invalid filter: {ex}", "error")
+        return redirect("/librarian/borrows")
+
+    page_size = lms.requested_page_size()
+    after, before = lms.requested_cursor("after"), lms.requested_cursor("before")
+    query, direction, limit = lms.keyset_query(query, page_size, after, before)
+    rows = await get_db()["bookings"].find(query).sort("_id", direction).limit(limit).to_list()
+    booking_details, prev_cursor, next_cursor = lms.keyset_rows(rows, page_size, after, before)
+    return render_template("librarian/borrows.html", catalog=booking_details, filters=filters,
+        prev_cursor=prev_cursor, next_cursor=next_cursor, page_size=page_size)
+
+async def librarian_profile():
+    if denied := access_denied("librarian"):
+        return denied
+
+    return render_template("librarian/profile.html", librarian=await get_profile("librarian", session["user_id"]))
+
+async def patron_dashboard():
+    if denied := access_denied("patron"):
+        return denied
+
+    return await catalog_page(lambda catalog: render_template("patron/dashboard.html", catalog=catalog),
+        lambda: get_db()["books"].find({"available": True}).to_list())
+
+async def patron_borrow_book(book_id):
+    if denied := access_denied("patron"):
+        return denied
+
+    borrowed, book = await borrow_and_book(book_id)
+    if borrowed:
+        flash("Unfortunately borrowed by others. Please contact your librarian for more info!", "warning")
+        return redirect("/patron/dashboard")
+    return render_template("patron/borrow_book.html", book=book, today=datetime.today().strftime('%Y-%m-%d'))
+
+async def patron_reserve_book(book_id):
+    if denied := access_denied("patron"):
+        return denied
+
+    borrowed, book = await borrow_and_book(book_id)
+    if borrowed:
+        flash("Unfortunately borrowed by others. Please contact your librarian for more info!", "warning")
+        return redirect("/patron/dashboard")
+    return render_template("patron/reserve_book.html", book=book)
+
+async def patron_recent_borrows_history():
+    if denied := access_denied("patron"):
+        return denied
+
+    # The sync page streams the whole history; a coroutine cannot stream the template, so rather
+    # than buffering every booking of the patron it serves one keyset page at a time
+    page_size = lms.requested_page_size()
+    after, before = lms.requested_cursor("after"), lms.requested_cursor("before")
+    query, direction, limit = lms.keyset_query({'patron_id': ObjectId(session['user_id'])}, page_size, after, before)
+    rows = await get_db()["bookings"].find(query).sort('_id', direction).limit(limit).to_list()
+    booking_details, prev_cursor, next_cursor = lms.keyset_rows(rows, page_size, after, before)
+    return render_template("patron/history.html", catalog=booking_details, dt=datetime,
+        prev_cursor=prev_cursor, next_cursor=next_cursor, page_size=page_size)
+
+async def patron_profile():
+    if denied := access_denied("patron"):
+        return denied
+
+    return render_template("patron/profile.html", patron=await get_profile("patron", session["user_id"]))
+
+ASYNC_VIEWS = {view.__name__: view for view in (librarian_available_books, book_borrows, librarian_profile,
+    patron_dashboard, patron_borrow_book, patron_reserve_book, patron_recent_borrows_history, patron_profile)}
+
+
+### ASGI APPLICATION ###
+
+def wsgi_environ(scope):
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode().decode("latin1"),
+        "PATH_INFO": scope["path"].encode().decode("latin1"),
+        "QUERY_STRING": scope["query_string"].decode("ascii"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "REMOTE_ADDR": scope["client"][0] if scope.get("client") else "",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin1").upper().replace("-", "_")
+        key = name if name in ("CONTENT_TYPE", "CONTENT_LENGTH") else f"HTTP_{name}"
+        environ[key] = f"{environ[key]},{value.decode('latin1')}" if key in environ else value.decode("latin1")
+    return environ
+
+async def dispatch(view, environ):
+    # Mirrors Flask.full_dispatch_request, awaiting the view in place of calling it
+    with lms.app.request_context(environ):
+        try:
+            try:
+                rv = lms.app.preprocess_request()
+                if rv is None:
+                    rv = await view(**request.view_args)
+            except Exception as ex:
+                rv = lms.app.handle_user_exception(ex)
+            response = lms.app.finalize_request(rv)
+        except Exception as ex:
+            response = lms.app.handle_exception(ex)
+        return response.status_code, response.get_wsgi_headers(environ), list(response.get_app_iter(environ))
+
+wsgi_app = WsgiToAsgi(lms.app)
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if _client_pid == os.getpid():
+                    await _client.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    view = None
+    if scope["type"] == "http" and scope["method"] in ("GET", "HEAD"):
+        environ = wsgi_environ(scope)
+        try:
+            endpoint, _ = lms.app.url_map.bind_to_environ(environ).match()
+            view = ASYNC_VIEWS.get(endpoint)
+        except HTTPException:
+            pass
+    if view is None:
+        return await wsgi_app(scope, receive, send)
+
+    status, headers, body = await dispatch(view, environ)
+    if scope["method"] == "HEAD":
+        body = list() # The headers (Content-Length included) are those of the GET, but no body is sent
+    await send({"type": "http.response.start", "status": status,
+        "headers": [(k.lower().encode("latin1"), v.encode("latin1")) for k, v in headers.items()]})
+    for chunk in body:
+        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+    await send({"type": "http.response.body", "body": b""})
@@ -0,0 +1,158 @@
+"""
+Sync (gunicorn threads, app:app) versus async (uvicorn, asgi:app) serving at high connection counts.
+
+Seeds a scratch database on a local mongod, then starts each server in turn with the same
+number of worker processes and drives it with an asyncio HTTP/1.1 load generator: every
+simulated connection is a keep-alive socket requesting the read-heavy routes served by the
+async mode (catalog, history, borrow form, borrows view, profile) back to back. Reports
+throughput, p50/p99 latency and errors side by side for each connection count.
+
+Needs gunicorn, uvicorn and asgiref on top of the app's requirements.
+
+Usage (against a local mongod):
+    MONGODB_URI=mongodb://localhost:27017 python benchmarks/async_vs_sync.py --connections 50,200,1000
+"""
+import os
+import sys
+import time
+import socket
+import random
+import asyncio
+import argparse
+import subprocess
+
+os.environ.setdefault("FLASK_APP_SECRET", "benchmark")
+os.environ.setdefault("MONGODB_DATABASE", "lms_benchmark_async")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as lms
+from load_test import seed
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVERS = {
+    "sync": "gunicorn --workers {workers} --threads {threads} --bind 127.0.0.1:{port} app:app",
+    "async": "uvicorn asgi:app --workers {workers} --host 127.0.0.1 --port {port} --no-access-log"
+}
+
+
+def session_cookie(role, user_id):
+    serializer = lms.app.session_interface.get_signing_serializer(lms.app)
+    return serializer.dumps(dict(user_id=str(user_id), user_name=role, user_role=role, user_email=f"{role}@example.com"))
+
+
+def route_mix(librarian_id, patron_ids, book_ids):
+    # (path, cookie) pairs, picked at random by every connection
+    librarian = session_cookie("librarian", librarian_id)
+    patrons = [session_cookie("patron", patron_id) for patron_id in patron_ids[:100]]
+    return lambda: random.choice([
+        ("/patron/dashboard", random.choice(patrons)),
+        ("/patron/history", random.choice(patrons)),
+        (f"/patron/borrow/{random.choice(book_ids)}", random.choice(patrons)),
+        ("/patron/profile", random.choice(patrons)),
+        ("/librarian/borrows", librarian),
+        ("/librarian/profile", librarian)
+    ])
+
+
+async def request(reader, writer, path, cookie):
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\nCookie: session={cookie}\r\n\r\n".encode())
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = dict()
+    while (line := await reader.readline()) not in (b"\r\n", b""):
+        name, _, value = line.decode("latin1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    if headers.get("transfer-encoding") == "chunked":
+        while size := int((await reader.readline()).split(b";")[0], 16):
+            await reader.readexactly(size + 2)
+        await reader.readline()
+    else:
+        await reader.readexactly(int(headers.get("content-length", 0)))
+    return status, headers.get("connection", "").lower() != "close"
+
+
+async def connection(port, pick, deadline, samples, errors):
+    reader = writer = None
+    while time.perf_counter() < deadline:
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            started = time.perf_counter()
+            status, keep_alive = await request(reader, writer, *pick())
+            samples.append((time.perf_counter() - started) * 1000)
+            if status >= 500:
+                errors.append(status)
+            if not keep_alive:
+                writer.close()
+                writer = None
+        except (OSError, asyncio.IncompleteReadError, ValueError, IndexError) as ex:
+            errors.append(type(ex).__name__)
+            if writer:
+                writer.close()
+            writer = None
+            await asyncio.sleep(0.05)
+    if writer:
+        writer.close()
+
+
+async def drive(port, pick, connections, seconds):
+    samples, errors = list(), list()
+    deadline = time.perf_counter() + seconds
+    await asyncio.gather(*(connection(port, pick, deadline, samples, errors) for _ in range(connections)))
+    samples.sort()
+    percentile = lambda q: samples[min(len(samples) - 1, int(len(samples) * q))] if samples else float("nan")
+    return dict(requests=len(samples), throughput=len(samples) / seconds, p50=percentile(0.50), p99=percentile(0.99),
+        errors=len(errors))
+
+
+def start_server(mode, port, workers, threads):
+    command = SERVERS[mode].format(workers=workers, threads=threads, port=port).split()
+    server = subprocess.Popen(command, cwd=APP_DIR, env=os.environ.copy(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.perf_counter() + 30
+    while time.perf_counter() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return server
+        except OSError:
+            if server.poll() is not None:
+                break
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError(f"{mode} server did not start: {' '.join(command)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--connections", default="50,200,1000", help="comma separated concurrent connection counts")
+    parser.add_argument("--seconds", type=float, default=20, help="duration of each run")
+    parser.add_argument("--workers", type=int, default=2, help="worker processes of either server")
+    parser.add_argument("--threads", type=int, default=32, help="threads per gunicorn worker (sync mode)")
+    parser.add_argument("--port", type=int, default=8731)
+    parser.add_argument("--books", type=int, default=20_000)
+    parser.add_argument("--patrons", type=int, default=1_000)
+    parser.add_argument("--bookings", type=int, default=50_000)
+    args = parser.parse_args()
+
+    print(f"[EVENT LOG]: Seeding {args.books} books, {args.patrons} patrons, {args.bookings} bookings...")
+    pick = route_mix(*seed(args.books, args.patrons, args.bookings))
+
+    results = dict()
+    for mode in SERVERS:
+        server = start_server(mode, args.port, args.workers, args.threads)
+        try:
+            for connections in map(int, args.connections.split(",")):
+                results[mode, connections] = asyncio.run(drive(args.port, pick, connections, args.seconds))
+        finally:
+            server.terminate()
+            server.wait()
+
+    print(f"{'connections':>11} | {'mode':>5} | {'req/s':>8} | {'p50':>9} | {'p99':>9} | {'errors':>6}")
+    for connections in map(int, args.connections.split(",")):
+        for mode in SERVERS:
+            r = results[mode, connections]
+            print(f"{connections:>11} | {mode:>5} | {r['throughput']:8.1f} | {r['p50']:7.1f}ms | {r['p99']:7.1f}ms | {r['errors']:>6}")
+    lms.db.client.drop_database(lms.db.name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""
+Headless load test of the LMS routes.
+
+Seeds a scratch database on a local mongod with a realistic catalog, patrons and bookings,
+then drives the real Flask routes through test clients from concurrent threads: login,
+dashboards, available books, borrows, history, borrow, reserve and renew. Reports the
+throughput and p50/p95/p99 latency of every route, optionally writes them as a JSON
+baseline, and compares a run against an earlier baseline to catch regressions.
+
+The handlers answer most failures with a redirect and a flashed message rather than an error
+status, so every response is classified from its flashes: an "error" flash (or a 5xx) is an
+error, a "warning" flash (a booked book, a wrong password, a busy hashing queue) is refused.
+Only the request itself is timed; picking the booking to renew is done beforehand.
+
+Usage (against a local mongod):
+    MONGODB_URI=mongodb://localhost:27017 python benchmarks/load_test.py --baseline-out baseline.json
+    MONGODB_URI=mongodb://localhost:27017 python benchmarks/load_test.py --compare baseline.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from datetime import datetime, timedelta
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault("FLASK_APP_SECRET", "benchmark")
+os.environ.setdefault("MONGODB_DATABASE", "lms_benchmark_load")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson import ObjectId
+import app as lms
+
+PASSWORD = "benchmark"
+
+
+def seed(books_count, patrons_count, bookings_count, batch_size=10_000):
+    lms.db.client.drop_database(lms.db.name)
+    lms.ensure_indexes()
+
+    password = lms.generate_password_hash(PASSWORD, method=os.getenv('HASH_METHOD'))
+    librarian_id = lms.librarians.insert_one(dict(name="librarian", email="librarian@example.com", password=password,
+        phone="+1 123 456 7890", institution="benchmark university")).inserted_id
+    patron_ids = lms.patrons.insert_many([dict(name=f"patron-{n}", email=f"patron-{n}@example.com", password=password,
+        phone="+1 123 456 7890", institution="benchmark university") for n in range(patrons_count)]).inserted_ids
+
+    book_ids, snapshots = list(), list()
+    for start in range(0, books_count, batch_size):
+        rows = [dict(book_cover_url=f"https://covers.example.com/{n}.jpg", title=f"Title {n}", author=f"Author {n % 997}",
+            genre=f"Genre {n % 31}", published=1900 + n % 120, librarian_id=librarian_id, available=True,
+            keywords=lms.search_keywords(f"Title {n}", f"Author {n % 997}", f"Genre {n % 31}"))
+            for n in range(start, min(start + batch_size, books_count))]
+        book_ids += lms.books.insert_many(rows, ordered=False).inserted_ids
+        snapshots += [lms.book_snapshot(row) for row in rows]
+
+    today = lms.to_booking_date(datetime.today())
+    for start in range(0, bookings_count, batch_size):
+        rows = list()
+        for n in range(start, min(start + batch_size, bookings_count)):
+            kind = "borrow" if n % 3 == 0 else "reserve"
+            checkin = today - timedelta(days=random.randint(0, 20)) if kind == "borrow" else today + timedelta(days=random.randint(1, 180))
+            b = random.randrange(len(book_ids))
+            rows.append(dict(book_id=book_ids[b], patron_id=random.choice(patron_ids), patron_name=f"patron-{n}",
+                type=kind, checkin_date=checkin, checkout_date=checkin + timedelta(days=random.randint(1, 21)),
+                book_details=snapshots[b]))
+        lms.bookings.insert_many(rows, ordered=False)
+    lms.rebuild_availability()
+    lms.rebuild_claims()
+    return librarian_id, patron_ids, book_ids
+
+
+class Scenario:
+    """Weighted mix of route calls, each made through a thread-local logged-in test client.
+
+    Every route returns the (client, method, path, form) of its request, so that any lookups
+    needed to build it stay out of the timed section.
+    """
+
+    def __init__(self, librarian_id, patron_ids, book_ids):
+        self.librarian_id, self.patron_ids, self.book_ids = str(librarian_id), patron_ids, book_ids
+        self.local = threading.local()
+        self.routes = [
+            ("POST /login", 1, self.login),
+            ("GET /patron/dashboard", 6, lambda: (self.patron(), "GET", "/patron/dashboard", None)),
+            ("GET /librarian/dashboard", 3, lambda: (self.librarian(), "GET", "/librarian/dashboard", None)),
+            ("GET /librarian/available/books", 2, lambda: (self.librarian(), "GET", "/librarian/available/books", None)),
+            ("GET /librarian/borrows", 2, lambda: (self.librarian(), "GET", "/librarian/borrows", None)),
+            ("GET /patron/history", 4, lambda: (self.patron(), "GET", "/patron/history", None)),
+            ("POST /patron/borrow", 2, self.borrow),
+            ("POST /patron/reserve", 2, self.reserve),
+            ("POST /patron/renew", 1, self.renew)
+        ]
+
+    def client(self, role, user_id, name):
+        key = f"{role}_client"
+        if not hasattr(self.local, key):
+            client = lms.app.test_client()
+            with client.session_transaction() as session:
+                session.update(user_id=user_id, user_name=name, user_role=role, user_email=f"{name}@example.com")
+            setattr(self.local, key, client)
+        return getattr(self.local, key)
+
+    def librarian(self):
+        return self.client("librarian", self.librarian_id, "librarian")
+
+    def patron(self):
+        if not hasattr(self.local, "patron_id"):
+            self.local.patron_id = random.choice(self.patron_ids)
+        return self.client("patron", str(self.local.patron_id), "patron")
+
+    def login(self):
+        n = random.randrange(len(self.patron_ids))
+        return lms.app.test_client(), "POST", "/login", dict(email=f"patron-{n}@example.com", password=PASSWORD, role="patron")
+
+    def borrow(self):
+        today = datetime.today().strftime('%Y-%m-%d')
+        checkout = (datetime.today() + timedelta(days=14)).strftime('%Y-%m-%d')
+        return self.patron(), "POST", f"/patron/borrow/{random.choice(self.book_ids)}", dict(checkin_date=today, checkout_date=checkout)
+
+    def reserve(self):
+        checkin = datetime.today() + timedelta(days=random.randint(1, 365))
+        return self.patron(), "POST", f"/patron/reserve/{random.choice(self.book_ids)}", dict(
+            checkin_date=checkin.strftime('%Y-%m-%d'), checkout_date=(checkin + timedelta(days=7)).strftime('%Y-%m-%d'))
+
+    def renew(self):
+        client = self.patron()
+        booking = lms.bookings.find_one({"patron_id": self.local.patron_id}, {"book_id": 1, "checkout_date": 1})
+        if not booking:
+            return client, "GET", "/patron/history", None
+        checkout = lms.to_booking_date(booking["checkout_date"]) + timedelta(days=7)
+        return client, "POST", f"/patron/renew/{booking['_id']}/book/{booking['book_id']}", dict(
+            checkout_date=checkout.strftime('%Y-%m-%d'))
+
+    def pick(self):
+        return random.choices(self.routes, weights=[weight for _, weight, _ in self.routes])[0]
+
+
+def percentile(samples, q):
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+def outcome(response, flashes):
+    categories = {category for category, _ in flashes}
+    if response.status_code == 503 and "Retry-After" in response.headers:
+        return "refused"
+    if response.status_code >= 500 or "error" in categories:
+        return "errors"
+    if "warning" in categories:
+        return "refused"
+    return "ok"
+
+
+def run(scenario, concurrency, requests_count):
+    latencies, outcomes = defaultdict(list), defaultdict(lambda: defaultdict(int))
+    lock = threading.Lock()
+
+    def call(_):
+        name, _, fn = scenario.pick()
+        client, method, path, form = fn()
+        started = time.perf_counter()
+        response = client.open(path, method=method, data=form)
+        elapsed = (time.perf_counter() - started) * 1000
+        # Redirects are not followed, so the flashes are still in the session; taking them keeps it small
+        with client.session_transaction() as session:
+            flashes = session.pop("_flashes", [])
+        with lock:
+            latencies[name].append(elapsed)
+            outcomes[name][outcome(response, flashes)] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(call, range(requests_count)))
+    wall = time.perf_counter() - started
+
+    report = dict()
+    for name, samples in sorted(latencies.items()):
+        samples.sort()
+        report[name] = dict(requests=len(samples), errors=outcomes[name]["errors"], refused=outcomes[name]["refused"], throughput=round(len(samples) / wall, 2),
+            p50=round(percentile(samples, 0.50), 3), p95=round(percentile(samples, 0.95), 3), p99=round(percentile(samples, 0.99), 3))
+    return report, wall
+
+
+def compare(report, baseline, tolerance):
+    regressions = list()
+    for name, current in report.items():
+        previous = baseline["routes"].get(name)
+        if previous and current["p95"] > previous["p95"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {previous['p95']}ms -> {current['p95']}ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--books", type=int, default=50_000)
+    parser.add_argument("--patrons", type=int, default=5_000)
+    parser.add_argument("--bookings", type=int, default=100_000)
+    parser.add_argument("--concurrency", type=int, default=16, help="threads issuing requests")
+    parser.add_argument("--requests", type=int, default=5_000, help="total requests across all routes")
+    parser.add_argument("--baseline-out", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON baseline to compare p95 latencies against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed p95 slowdown before failing")
+    parser.add_argument("--keep", action="store_true", help="keep the seeded database")
+    args = parser.parse_args()
+
+    print(f"[EVENT LOG]: Seeding {args.books} books, {args.patrons} patrons, {args.bookings} bookings...")
+    scenario = Scenario(*seed(args.books, args.patrons, args.bookings))
+    report, wall = run(scenario, args.concurrency, args.requests)
+
+    print(f"{'route':>32} | {'reqs':>6} | {'err':>4} | {'ref':>4} | {'req/s':>8} | {'p50':>9} | {'p95':>9} | {'p99':>9}")
+    for name, r in report.items():
+        print(f"{name:>32} | {r['requests']:>6} | {r['errors']:>4} | {r['refused']:>4} | {r['throughput']:>8} | "
+            f"{r['p50']:>7}ms | {r['p95']:>7}ms | {r['p99']:>7}ms")
+    print(f"[EVENT LOG]: {args.requests} requests in {wall:.1f}s ({args.requests / wall:.1f} req/s)")
+
+    if args.baseline_out:
+        with open(args.baseline_out, "w") as fhand:
+            json.dump(dict(created_at=datetime.utcnow().isoformat(), config=vars(args), routes=report), fhand, indent=2)
+    if not args.keep:
+        lms.db.client.drop_database(lms.db.name)
+
+    if args.compare:
+        with open(args.compare) as fhand:
+            regressions = compare(report, json.load(fhand), args.tolerance)
+        for regression in regressions:
+            print(f"[REGRESSION]: {regression}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Catalog latency during a login storm, with and without the password hashing pool.
+
+A fixed pool of threads stands in for the WSGI server's request threads. Login requests
+are fired at it continuously while a sampler times patron dashboard requests submitted
+to the same threads, so the reported latency includes the time spent waiting for a free
+thread. The run is repeated with hashing inline (HASH_WORKERS=0) and with the pool. Logins
+turned away by the full hashing queue (503) are counted apart from the successful ones, and
+any other answer as failed, so a mode cannot look faster by dropping more of the storm.
+
+Usage (against a local mongod):
+    MONGODB_URI=mongodb://localhost:27017 HASH_METHOD=scrypt python benchmarks/login_storm.py
+"""
+import os
+import sys
+import time
+import argparse
+import threading
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault("FLASK_APP_SECRET", "benchmark")
+os.environ.setdefault("MONGODB_DATABASE", "lms_benchmark_login_storm")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as lms
+
+
+def seed(patrons_count):
+    lms.db.client.drop_database(lms.db.name)
+    lms.ensure_indexes()
+    password = lms.generate_password_hash("benchmark", method=os.getenv('HASH_METHOD'))
+    lms.patrons.insert_many([dict(name=f"patron-{n}", email=f"patron-{n}@example.com", password=password,
+        phone="+1 123 456 7890", institution="benchmark university") for n in range(patrons_count)])
+    lms.books.insert_many([dict(book_cover_url=f"cover-{n}", title=f"title-{n}", author="author", genre="genre",
+        published=2000, available=True) for n in range(200)])
+
+
+def logged_in_client():
+    client = lms.app.test_client()
+    with client.session_transaction() as session:
+        session.update(user_id=str(lms.patrons.find_one()["_id"]), user_name="patron-0", user_role="patron",
+            user_email="patron-0@example.com")
+    return client
+
+
+def run(hash_workers, server_threads, storm_seconds, logins_in_flight, patrons_count):
+    lms.app.config['HASH_WORKERS'] = hash_workers
+    server = ThreadPoolExecutor(max_workers=server_threads)
+    stop = threading.Event()
+    local = threading.local()
+    outcomes, outcomes_lock = dict(succeeded=0, rejected=0, failed=0), threading.Lock()
+
+    def client():
+        if not hasattr(local, "client"):
+            local.client = logged_in_client()
+        return local.client
+
+    def login(n):
+        response = lms.app.test_client().post("/login", data=dict(email=f"patron-{n % patrons_count}@example.com",
+            password="benchmark", role="patron"))
+        # A login refused by the full hashing queue is answered 503; a signed-in patron lands on the dashboard
+        if response.status_code == 503:
+            outcome = "rejected"
+        elif response.status_code == 302 and response.location.endswith("/patron/dashboard"):
+            outcome = "succeeded"
+        else:
+            outcome = "failed"
+        with outcomes_lock:
+            outcomes[outcome] += 1
+
+    def storm():
+        n, pending = 0, list()
+        while not stop.is_set():
+            pending = [f for f in pending if not f.done()]
+            while len(pending) < logins_in_flight:
+                pending.append(server.submit(login, n))
+                n += 1
+            time.sleep(0.001)
+
+    samples = list()
+
+    def catalog():
+        submitted = time.perf_counter()
+        server.submit(lambda: client().get("/patron/dashboard")).result()
+        samples.append((time.perf_counter() - submitted) * 1000)
+
+    storm_thread = threading.Thread(target=storm, daemon=True)
+    storm_thread.start()
+    started = time.perf_counter()
+    deadline = started + storm_seconds
+    while time.perf_counter() < deadline:
+        catalog()
+        time.sleep(0.01)
+    stop.set()
+    storm_thread.join()
+    server.shutdown(wait=True)
+    elapsed = time.perf_counter() - started
+
+    samples.sort()
+    return (len(samples), statistics.median(samples), samples[int(len(samples) * 0.99) - 1],
+        outcomes["succeeded"] / elapsed, outcomes["rejected"], outcomes["failed"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=8, help="request threads of the simulated server")
+    parser.add_argument("--seconds", type=float, default=15, help="duration of each storm")
+    parser.add_argument("--in-flight", type=int, default=64, help="login requests kept in flight")
+    parser.add_argument("--hash-workers", type=int, default=2, help="HASH_WORKERS for the pooled run")
+    parser.add_argument("--patrons", type=int, default=100)
+    args = parser.parse_args()
+
+    seed(args.patrons)
+    print(f"{'mode':>16} | {'samples':>7} | {'catalog p50':>11} | {'catalog p99':>11} | {'logins/s':>8} | {'rejected':>8} | {'failed':>6}")
+    for label, workers in (("inline", 0), (f"pool ({args.hash_workers})", args.hash_workers)):
+        count, p50, p99, logins_per_second, rejected, failed = run(workers, args.threads, args.seconds, args.in_flight, args.patrons)
+        print(f"{label:>16} | {count:>7} | {p50:9.1f}ms | {p99:9.1f}ms | {logins_per_second:8.1f} | {rejected:>8} | {failed:>6}")
+    lms.db.client.drop_database(lms.db.name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Reservation conflict lookup benchmark.
+
+Seeds a scratch database with a growing number of reservations spread over many
+books, derives the books' claims from them, and times the conflict test run by
+borrow/reserve (`claim_query`: the book's _id lookup with its claims $elemMatch).
+The latency should stay flat as the total number of reservations grows, while the
+legacy full scan of the bookings grows linearly with it.
+
+Usage (against a local mongod):
+    MONGODB_URI=mongodb://localhost:27017 python benchmarks/reservation_conflicts.py
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import statistics
+from datetime import datetime, timedelta
+
+os.environ.setdefault("FLASK_APP_SECRET", "benchmark")
+os.environ.setdefault("MONGODB_DATABASE", "lms_benchmark_reservations")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson import ObjectId
+import app as lms
+
+
+def seed(total, books_count, batch_size=10_000):
+    start = lms.to_booking_date(datetime.today())
+    book_ids = [ObjectId() for _ in range(books_count)]
+    lms.books.insert_many([dict(_id=book_id, title=str(book_id), book_cover_url=str(book_id), available=True)
+        for book_id in book_ids], ordered=False)
+    batch = list()
+    for n in range(total):
+        checkin = start + timedelta(days=random.randint(0, 365))
+        checkout = checkin + timedelta(days=random.randint(1, 21))
+        batch.append({
+            "book_id": random.choice(book_ids),
+            "patron_id": ObjectId(),
+            "patron_name": f"patron-{n}",
+            "type": "reserve",
+            "checkin_date": checkin,
+            "checkout_date": checkout
+        })
+        if len(batch) == batch_size:
+            lms.bookings.insert_many(batch, ordered=False)
+            batch.clear()
+    if batch:
+        lms.bookings.insert_many(batch, ordered=False)
+    lms.rebuild_claims()
+    return book_ids
+
+
+def claim_lookup(book_id, start, end):
+    return lms.books.find_one(lms.claim_query(ObjectId(book_id), start, end), {"_id": 1})
+
+
+def legacy_scan(book_id, start, end):
+    reservations = list(lms.bookings.find({"type": "reserve"}, {"book_id": 1, "checkin_date": 1, "checkout_date": 1, "_id": 0}))
+    for b in reservations:
+        if str(b["book_id"]) == book_id:
+            s = lms.to_booking_date(b["checkin_date"])
+            e = lms.to_booking_date(b["checkout_date"])
+            if start <= e and end >= s:
+                return b
+    return None
+
+
+def measure(fn, book_ids, runs):
+    samples = list()
+    for _ in range(runs):
+        book_id = str(random.choice(book_ids))
+        start = datetime.today() + timedelta(days=random.randint(0, 365))
+        end = start + timedelta(days=14)
+        t0 = time.perf_counter()
+        fn(book_id, start, end)
+        samples.append((time.perf_counter() - t0) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.99) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000,100000,500000", help="comma separated reservation totals")
+    parser.add_argument("--books", type=int, default=20_000, help="distinct books the reservations are spread over")
+    parser.add_argument("--runs", type=int, default=500, help="lookups timed per size")
+    parser.add_argument("--legacy-max", type=int, default=100_000, help="largest size the legacy scan is timed at")
+    args = parser.parse_args()
+
+    lms.db.client.drop_database(lms.db.name)
+    lms.ensure_indexes()
+
+    seeded = 0
+    book_ids = list()
+    print(f"{'reservations':>12} | {'claim p50':>11} | {'claim p99':>11} | {'legacy p50':>10}")
+    for size in map(int, args.sizes.split(",")):
+        book_ids += seed(size - seeded, args.books)
+        seeded = size
+        p50, p99 = measure(claim_lookup, book_ids, args.runs)
+        legacy = "-"
+        if size <= args.legacy_max:
+            legacy = f"{measure(legacy_scan, book_ids, max(args.runs // 50, 5))[0]:8.2f}ms"
+        print(f"{size:>12} | {p50:9.3f}ms | {p99:9.3f}ms | {legacy:>10}")
+
+    lms.db.client.drop_database(lms.db.name)
+
+
+if __name__ == "__main__":
+    main()
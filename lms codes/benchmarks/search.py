@@ -0,0 +1,78 @@
+"""
+Catalog search benchmark.
+
+Seeds a scratch database with a synthetic catalog and times `search_books` for queries of
+growing breadth, from a rare whole word to a one-letter prefix matching most of the catalog.
+Each query is run with the SEARCH_CANDIDATES cap and uncapped (every match scored), and the
+report shows how many books matched, the p50/p99 latency of both, and how many of the capped
+top results also appear in the uncapped ones, i.e. what the cap costs in ranking quality.
+
+Usage (against a local mongod):
+    MONGODB_URI=mongodb://localhost:27017 python benchmarks/search.py --books 100000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import statistics
+
+os.environ.setdefault("FLASK_APP_SECRET", "benchmark")
+os.environ.setdefault("MONGODB_DATABASE", "lms_benchmark_search")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as lms
+
+WORDS = ["history", "war", "peace", "garden", "river", "night", "émile", "société", "ocean", "winter", "glass",
+    "city", "music", "stone", "mirror", "letters", "island", "forest", "machine", "silence"]
+GENRES = ["fiction", "history", "science", "poetry", "biography", "fantasy"]
+QUERIES = ["silence mirror", "émile", "société", "river", "hist", "a"]
+
+
+def seed(books_count, batch_size=10_000):
+    lms.db.client.drop_database(lms.db.name)
+    lms.ensure_indexes()
+    for start in range(0, books_count, batch_size):
+        rows = list()
+        for n in range(start, min(start + batch_size, books_count)):
+            title = " ".join(random.sample(WORDS, 3)) + f" {n}"
+            author, genre = f"author {random.choice(WORDS)} {n % 997}", random.choice(GENRES)
+            rows.append(dict(book_cover_url=f"https://covers.example.com/{n}.jpg", title=title, author=author, genre=genre,
+                published=1900 + n % 120, available=True, keywords=lms.search_keywords(title, author, genre)))
+        lms.books.insert_many(rows, ordered=False)
+
+
+def measure(query, limit, runs):
+    samples, results = list(), None
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        results = lms.search_books(query, limit)
+        samples.append((time.perf_counter() - t0) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[max(0, int(len(samples) * 0.99) - 1)], [book["_id"] for book in results]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--books", type=int, default=100_000)
+    parser.add_argument("--limit", type=int, default=25, help="results per search (the page size)")
+    parser.add_argument("--runs", type=int, default=50, help="searches timed per query and mode")
+    args = parser.parse_args()
+
+    print(f"[EVENT LOG]: Seeding {args.books} books...")
+    seed(args.books)
+    cap = lms.app.config['SEARCH_CANDIDATES']
+    print(f"{'query':>16} | {'matches':>8} | {f'capped ({cap}) p50':>18} | {'p99':>9} | {'uncapped p50':>12} | {'p99':>9} | {'same top':>8}")
+    for query in QUERIES:
+        matches = lms.books.count_documents(lms.search_query(lms.tokenize(query)[:8]))
+        capped_p50, capped_p99, capped = measure(query, args.limit, args.runs)
+        lms.app.config['SEARCH_CANDIDATES'] = args.books
+        full_p50, full_p99, full = measure(query, args.limit, args.runs)
+        lms.app.config['SEARCH_CANDIDATES'] = cap
+        print(f"{query:>16} | {matches:>8} | {capped_p50:16.1f}ms | {capped_p99:7.1f}ms | {full_p50:10.1f}ms | {full_p99:7.1f}ms | "
+            f"{len(set(capped) & set(full)):>3}/{len(full):<4}")
+    lms.db.client.drop_database(lms.db.name)
+
+
+if __name__ == "__main__":
+    main()
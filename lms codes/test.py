@@ -1,16 +1,68 @@
+import os
+import gzip
+import json
+import tempfile
 import string
+import asyncio
 import random
 import unittest
-import chromedriver_autoinstaller
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from webdriver_manager.chrome import ChromeDriverManager
+import threading
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from bson import ObjectId
+from pymongo import monitoring
+from pymongo.errors import PyMongoError, BulkWriteError
+
+# The browser tests need the selenium tooling and a running server; the in-process tests do not
+try:
+    import chromedriver_autoinstaller
+    from selenium import webdriver
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+    from webdriver_manager.chrome import ChromeDriverManager
+except ImportError:
+    webdriver = None
 
 def generate_random_string(length=8):
     return ''.join(random.choice(string.ascii_letters + string.digits) for i in range(length))
 
+class CommandCounter(monitoring.CommandListener):
+    """Counts the commands (round trips) sent to MongoDB by the app."""
+    count = 0
+
+    def started(self, event):
+        self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+# Registered before the app builds its MongoClient; the in-process tests use their own database
+command_counter = CommandCounter()
+monitoring.register(command_counter)
+os.environ.setdefault("MONGODB_DATABASE", "library_management_system_test")
+os.environ.setdefault("FLASK_APP_SECRET", "test")
+os.environ.setdefault("MONGODB_SERVER_SELECTION_TIMEOUT_MS", "2000")
+import app as lms
+try:
+    import asgi
+except ImportError: # asgiref is optional
+    asgi = None
+
+def mongod_available():
+    try:
+        lms.get_client().admin.command("ping")
+        return True
+    except PyMongoError:
+        return False
+
+requires_mongod = unittest.skipUnless(mongod_available(), "needs a local mongod")
+
+@unittest.skipIf(webdriver is None, "needs selenium and chromedriver_autoinstaller")
 class LibraryManagementSystemTest(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -299,5 +351,480 @@ class LibraryManagementSystemTest(unittest.TestCase):
     def tearDownClass(cls):
         cls.driver.quit()
 
+@requires_mongod
+class RoundTripTest(unittest.TestCase):
+    """In-process tests of the MongoDB round trips per write route (needs a local mongod)."""
+
+    @classmethod
+    def setUpClass(cls):
+        lms.app.config['HASH_WORKERS'] = 0
+        lms.ensure_indexes()
+        cls.librarian_id = lms.librarians.insert_one(dict(name="librarian", email=f"{generate_random_string()}@example.com")).inserted_id
+        cls.patron_id = lms.patrons.insert_one(dict(name="patron", email=f"{generate_random_string()}@example.com")).inserted_id
+
+    def logged_in_client(self, role, user_id):
+        client = lms.app.test_client()
+        with client.session_transaction() as session:
+            session.update(user_id=str(user_id), user_name=role, user_role=role, user_email=f"{role}@example.com")
+        return client
+
+    def round_trips(self, call):
+        before = command_counter.count
+        response = call()
+        self.assertEqual(response.status_code, 302)
+        return command_counter.count - before
+
+    def test_register_user(self):
+        client = lms.app.test_client()
+        form = dict(name=(x:=generate_random_string()), email=f"{x}@example.com", password=x, phone="+1 123 456 7890",
+            institution=f"{x} university", role="patron")
+        self.assertEqual(self.round_trips(lambda: client.post("/register", data=form)), 1)
+        self.assertEqual(self.round_trips(lambda: client.post("/register", data=form)), 1) # Duplicate email
+        self.assertEqual(lms.patrons.count_documents(dict(email=form["email"])), 1)
+
+    def test_add_book(self):
+        client = self.logged_in_client("librarian", self.librarian_id)
+        form = dict(book_cover_url=f"https://covers.example.com/{(x:=generate_random_string())}.jpg", title=x,
+            author="author", genre="genre", published="2001")
+        # Insert only: the new book moves the catalog version without a counter bump
+        self.assertEqual(self.round_trips(lambda: client.post("/librarian/add/book", data=form)), 1)
+        self.assertEqual(self.round_trips(lambda: client.post("/librarian/add/book", data=dict(form, book_cover_url="other"))), 1) # Duplicate title
+        self.assertEqual(lms.books.count_documents(dict(title=x)), 1)
+
+    def test_renew_booking(self):
+        client = self.logged_in_client("patron", self.patron_id)
+        book_id, booking_id, today = ObjectId(), ObjectId(), lms.to_booking_date(datetime.today())
+        lms.books.insert_one(dict(_id=book_id, title=generate_random_string(), book_cover_url=generate_random_string(), available=False,
+            claims=[dict(booking_id=booking_id, checkin=today, checkout=today + timedelta(days=7))]))
+        lms.bookings.insert_one(dict(_id=booking_id, book_id=book_id, patron_id=self.patron_id, patron_name="patron", type="borrow",
+            checkin_date=today.strftime('%Y-%m-%d'), checkout_date=(today + timedelta(days=7)).strftime('%Y-%m-%d')))
+        checkout_date = today + timedelta(days=14)
+
+        # Claim extension + conditional update + circulation rollups
+        self.assertEqual(self.round_trips(lambda: client.post(f"/patron/renew/{booking_id}/book/{book_id}",
+            data=dict(checkout_date=checkout_date.strftime('%Y-%m-%d')))), 3)
+        self.assertEqual(lms.rollups.find_one({"_id": f"book:{book_id}"})["renewals"], 1)
+        self.assertEqual(lms.books.find_one(dict(_id=book_id))["claims"][0]["checkout"], checkout_date)
+        booking = lms.bookings.find_one(dict(_id=booking_id))
+        self.assertEqual((booking["checkin_date"], booking["checkout_date"]), (today, checkout_date))
+
+    def test_renew_reservation(self):
+        client = self.logged_in_client("patron", self.patron_id)
+        book_id, today = ObjectId(), lms.to_booking_date(datetime.today())
+        day = lambda n: today + timedelta(days=n)
+        reservation_id, legacy_id = ObjectId(), ObjectId()
+        # Another patron's loan ends before the reservation starts; the second reservation has no claim yet
+        lms.books.insert_one(dict(_id=book_id, title=generate_random_string(), book_cover_url=generate_random_string(), available=True,
+            claims=[dict(booking_id=ObjectId(), checkin=day(0), checkout=day(5)), dict(booking_id=reservation_id, checkin=day(10), checkout=day(12))]))
+        lms.bookings.insert_many([dict(_id=booking_id, book_id=book_id, patron_id=self.patron_id, patron_name="patron", type="reserve",
+            checkin_date=day(start), checkout_date=day(start + 2)) for booking_id, start in ((reservation_id, 10), (legacy_id, 20))])
+
+        for booking_id, checkout_date in ((reservation_id, day(14)), (legacy_id, day(24))):
+            client.post(f"/patron/renew/{booking_id}/book/{book_id}", data=dict(checkout_date=checkout_date.strftime('%Y-%m-%d')))
+            self.assertEqual(lms.bookings.find_one(dict(_id=booking_id))["checkout_date"], checkout_date)
+        claims = {claim["booking_id"]: claim for claim in lms.books.find_one(dict(_id=book_id))["claims"]}
+        self.assertEqual((claims[reservation_id]["checkout"], claims[legacy_id]["checkout"]), (day(14), day(24)))
+
+    def test_pay_fine(self):
+        client = self.logged_in_client("patron", self.patron_id)
+        today = lms.to_booking_date(datetime.today())
+        # Overdue for 6 days, with fines last computed before it fell due
+        booking_id = lms.bookings.insert_one(dict(book_id=ObjectId(), patron_id=self.patron_id, patron_name="patron", type="borrow",
+            checkin_date=today - timedelta(days=13), checkout_date=today - timedelta(days=6), overdue_days=0, fine=0)).inserted_id
+        form = dict(payment_method="card", card_name="patron", card_number="4242424242424242", card_exp_month="1",
+            card_exp_year="2030", cvv="123")
+
+        # The amount in the URL is ignored, the fine due as of today is paid
+        self.assertEqual(self.round_trips(lambda: client.post(f"/patron/pay_fine/0.01/{booking_id}/book/x", data=form)), 1)
+        self.assertEqual(lms.bookings.find_one(dict(_id=booking_id))["fine_paid"], 6 * lms.app.config['FINE_PER_DAY'])
+        self.assertEqual(self.round_trips(lambda: client.get(f"/patron/pay_fine/{booking_id}/book/x")), 1) # Nothing left to pay
+
+    def test_api_patron_bookings(self):
+        client = self.logged_in_client("patron", self.patron_id)
+        today = lms.to_booking_date(datetime.today())
+        booking_id = lms.bookings.insert_one(dict(book_id=ObjectId(), patron_id=self.patron_id, patron_name="patron", type="reserve",
+            checkin_date=today, checkout_date=today + timedelta(days=7))).inserted_id
+
+        before = command_counter.count
+        response = client.get("/api/v1/patron/bookings?fields=type,checkin_date")
+        self.assertEqual(command_counter.count - before, 1)
+        self.assertEqual(response.status_code, 200)
+        booking = next(b for b in response.json["bookings"] if b["_id"] == str(booking_id))
+        self.assertEqual(booking, dict(_id=str(booking_id), type="reserve", checkin_date=today.isoformat()))
+        self.assertEqual(lms.app.test_client().get("/api/v1/patron/bookings").status_code, 401)
+        self.assertEqual(self.logged_in_client("librarian", self.librarian_id).get("/api/v1/patron/bookings").status_code, 403)
+
+    @classmethod
+    def tearDownClass(cls):
+        lms.db.client.drop_database(lms.db.name)
+
+@unittest.skipUnless(lms.orjson, "orjson is not installed")
+class JSONProviderTest(unittest.TestCase):
+    def test_jsonify_uses_orjson(self):
+        booking_id, today = ObjectId(), datetime(2030, 1, 1)
+        with mock.patch.object(lms.orjson, "dumps", wraps=lms.orjson.dumps) as dumps, lms.app.app_context():
+            response = lms.jsonify(_id=booking_id, checkin_date=today)
+        dumps.assert_called_once()
+        self.assertEqual(response.json, dict(_id=str(booking_id), checkin_date=today.isoformat()))
+
+@requires_mongod
+class ConcurrentBookingTest(unittest.TestCase):
+    """Hundreds of simultaneous bookings of one book, of which exactly one may win (needs a local mongod)."""
+
+    ATTEMPTS = 300
+
+    def setUp(self):
+        self.book_id = lms.books.insert_one(dict(title=generate_random_string(), author="author", genre="genre", published=2001,
+            book_cover_url=generate_random_string(), available=True)).inserted_id
+
+    def storm(self, path, form):
+        # Every thread logs in its own patron, then all of them post at once
+        barrier = threading.Barrier(self.ATTEMPTS)
+
+        def attempt(n):
+            client = lms.app.test_client()
+            with client.session_transaction() as session:
+                session.update(user_id=str(ObjectId()), user_name=f"patron-{n}", user_role="patron", user_email=f"patron-{n}@example.com")
+            barrier.wait()
+            return client.post(path, data=form).status_code
+
+        with ThreadPoolExecutor(max_workers=self.ATTEMPTS) as pool:
+            self.assertEqual(set(pool.map(attempt, range(self.ATTEMPTS))), {302})
+
+    def test_concurrent_borrows(self):
+        today = datetime.today()
+        self.storm(f"/patron/borrow/{self.book_id}", dict(checkin_date=today.strftime('%Y-%m-%d'),
+            checkout_date=(today + timedelta(days=7)).strftime('%Y-%m-%d')))
+        self.assertEqual(lms.bookings.count_documents(dict(book_id=self.book_id)), 1)
+        book = lms.books.find_one(dict(_id=self.book_id))
+        self.assertFalse(book["available"])
+        self.assertEqual(len(book["claims"]), 1)
+
+    def test_concurrent_reservations(self):
+        checkin = datetime.today() + timedelta(days=30)
+        self.storm(f"/patron/reserve/{self.book_id}", dict(checkin_date=checkin.strftime('%Y-%m-%d'),
+            checkout_date=(checkin + timedelta(days=7)).strftime('%Y-%m-%d')))
+        self.assertEqual(lms.bookings.count_documents(dict(book_id=self.book_id)), 1)
+        self.assertEqual(len(lms.books.find_one(dict(_id=self.book_id))["claims"]), 1)
+
+    @classmethod
+    def tearDownClass(cls):
+        lms.db.client.drop_database(lms.db.name)
+
+class ClientOptionsTest(unittest.TestCase):
+    def test_client_with_and_without_metrics(self):
+        # Building a client does not connect, so no mongod is needed
+        for enabled in (True, False):
+            with mock.patch.dict(lms.app.config, METRICS_ENABLED=enabled):
+                client = lms.MongoClient(**lms.client_options())
+            listeners = client.options.event_listeners
+            self.assertEqual(lms.command_metrics in listeners, enabled)
+            client.close()
+
+class HashingBusyTest(unittest.TestCase):
+    def test_login_refused_by_full_hashing_queue(self):
+        patrons = mock.Mock(find_one=mock.Mock(return_value=dict(_id=ObjectId(), name="patron", password="hash")))
+        client = lms.app.test_client()
+        with mock.patch.object(lms, "patrons", patrons), mock.patch.object(lms, "verify_password", side_effect=TimeoutError), \
+                mock.patch.object(lms, "render_template", return_value="login form") as render_template:
+            response = client.post("/login", data=dict(email="patron@example.com", password="password", role="patron"))
+        # The login form is served again, not the /register redirect of the other errors
+        render_template.assert_called_once_with("login.html")
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers["Retry-After"], str(lms.app.config['HASH_RETRY_AFTER']))
+        with client.session_transaction() as session:
+            self.assertEqual(session["_flashes"], [("warning", "Too many sign-ins in progress! Please re-try in a moment.")])
+        self.assertNotIn("user_id", session)
+
+@unittest.skipIf(asgi is None, "asgiref is not installed")
+class AsgiTest(unittest.TestCase):
+    def test_head_sends_no_body(self):
+        async def view():
+            return "about"
+
+        async def send(message):
+            sent.append(message)
+
+        sent, scope = list(), dict(type="http", method="HEAD", path="/about", query_string=b"", headers=list(), http_version="1.1")
+        with mock.patch.dict(asgi.ASYNC_VIEWS, about_us=view):
+            asyncio.run(asgi.app(scope, None, send))
+        self.assertEqual(sent[0]["status"], 200)
+        self.assertIn((b"content-length", b"5"), sent[0]["headers"])
+        self.assertEqual([message["body"] for message in sent[1:]], [b""])
+
+class InvalidationBusTest(unittest.TestCase):
+    def test_unexpected_error_drops_the_connection_and_backs_off(self):
+        class Stop(BaseException):
+            pass
+
+        stream = mock.MagicMock(alive=True, resume_token=None)
+        stream.__enter__.return_value = stream
+        stream.try_next.side_effect = ValueError("malformed event")
+        database, jobs, bus = mock.Mock(watch=mock.Mock(return_value=stream)), mock.Mock(find_one=mock.Mock(return_value=None)), lms.InvalidationBus()
+        with mock.patch.object(lms, "db", database), mock.patch.object(lms, "jobs", jobs), \
+                mock.patch.object(lms.time, "sleep", side_effect=[None, Stop]) as sleep, mock.patch.object(bus, "flush") as flush:
+            with self.assertRaises(Stop):
+                bus.run()
+        # The thread survived the first failure, reconnected once and backs off exponentially
+        self.assertEqual([c.args[0] for c in sleep.call_args_list], [1, 2])
+        self.assertEqual(bus.stats(), dict(connected=False, events=0, reconnects=2))
+        self.assertEqual(flush.call_count, 2)
+
+class CatalogVersionTest(unittest.TestCase):
+    def remember(self):
+        lms.remember_catalog_version((dict(version=1), None, 0), lms.catalog_generation())
+        self.assertIsNotNone(lms.cached_catalog_version())
+
+    def test_inserts_expire_the_cached_version(self):
+        books = mock.Mock(find=mock.Mock(return_value=list()))
+        books.insert_many.return_value.inserted_ids = [ObjectId()]
+        books.insert_one.return_value.inserted_id = ObjectId()
+        form = dict(book_cover_url="cover", title="title", author="author", genre="genre", published="2001")
+        client = lms.app.test_client()
+        with client.session_transaction() as session:
+            session.update(user_id=str(ObjectId()), user_name="librarian", user_role="librarian", user_email="librarian@example.com")
+
+        with mock.patch.object(lms, "books", books):
+            self.remember()
+            lms.insert_book_batch([(1, lms.book_from_row(form, ObjectId()))], dict(inserted=0, duplicates=0, errors=list()))
+            self.assertIsNone(lms.cached_catalog_version())
+            self.remember()
+            client.post("/librarian/add/book", data=form)
+            self.assertIsNone(lms.cached_catalog_version())
+
+class SearchTest(unittest.TestCase):
+    def test_candidates_capped_before_scoring(self):
+        books = mock.Mock(aggregate=mock.Mock(return_value=iter(list())))
+        with mock.patch.object(lms, "books", books), mock.patch.dict(lms.app.config, SEARCH_CANDIDATES=50):
+            lms.search_books("Émile Zo", 10)
+        pipeline = books.aggregate.call_args.args[0]
+        self.assertEqual(pipeline[0], {"$match": lms.search_query(["émile", "zo"])})
+        self.assertEqual(pipeline[1], {"$limit": 50})
+        self.assertIn("score", pipeline[2]["$project"])
+
+    def test_word_boundaries_are_unicode(self):
+        # PCRE's \b is ASCII-only: the score must use the same (Unicode) words as tokenize
+        patterns = [c["$cond"][0]["$regexMatch"]["regex"] for c in lms.search_score(["émile"])["$add"]]
+        self.assertEqual(patterns[0], "(?<![\\p{L}\\p{N}_])émile(?![\\p{L}\\p{N}_])")
+        self.assertNotIn("\\b", "".join(patterns))
+
+class ImportBooksTest(unittest.TestCase):
+    def test_duplicates_are_not_errors(self):
+        row = lambda n: dict(book_cover_url=f"cover-{n}", title=f"title-{n}", author="author", genre="genre", published="2001")
+        books = mock.Mock(find=mock.Mock(return_value=[dict(title="title-1", book_cover_url="cover-1")]))
+        # Of the three rows left to insert, one was listed meanwhile and one fails validation
+        books.insert_many.side_effect = BulkWriteError(dict(nInserted=1, writeErrors=[dict(index=0, code=11000, errmsg="E11000"),
+            dict(index=2, code=121, errmsg="Document failed validation")]))
+        rows = [(1, row(1)), (2, row(2)), (3, dict(row(3), published="unknown")), (4, row(4)), (5, row(5))]
+        with mock.patch.object(lms, "books", books):
+            report = lms.import_books(rows, ObjectId())
+        self.assertEqual((report["rows"], report["inserted"], report["duplicates"]), (5, 1, 2))
+        self.assertEqual([error["row"] for error in report["errors"]], [3, 5])
+
+class KeysetPaginationTest(unittest.TestCase):
+    """Cursors of the keyset pages, checked against an in-memory run of the queries."""
+
+    ROWS = [dict(_id=ObjectId()) for _ in range(7)]
+
+    def fetch(self, query, direction, limit):
+        compare = {"$gt": lambda a, b: a > b, "$lt": lambda a, b: a < b}
+        rows = [r for r in self.ROWS if all(compare[op](r["_id"], v) for op, v in query.get("_id", dict()).items())]
+        return sorted(rows, key=lambda r: r["_id"], reverse=direction < 0)[:limit]
+
+    def page(self, after=None, before=None):
+        rows, prev_cursor, next_cursor = lms.keyset_page(self.fetch, dict(), 3, after, before)
+        return [self.ROWS.index(r) for r in rows], prev_cursor, next_cursor
+
+    def test_next_and_prev_boundaries(self):
+        cursor = lambda n: str(self.ROWS[n]["_id"])
+        self.assertEqual(self.page(), ([0, 1, 2], None, cursor(2))) # First page: no previous page
+        self.assertEqual(self.page(after=cursor(2)), ([3, 4, 5], cursor(3), cursor(5)))
+        self.assertEqual(self.page(after=cursor(5)), ([6], cursor(6), None)) # Last page: no next page
+        self.assertEqual(self.page(after=cursor(6)), ([], None, None))
+        self.assertEqual(self.page(before=cursor(6)), ([3, 4, 5], cursor(3), cursor(5)))
+        self.assertEqual(self.page(before=cursor(3)), ([0, 1, 2], None, cursor(2))) # Back on the first page
+        self.assertEqual(self.page(before=cursor(1)), ([0], None, cursor(0)))
+
+    def test_malformed_cursor_falls_back_to_the_first_page(self):
+        for query_string in ("after=not-an-id", "before=1234", "after=", "before=%00"):
+            with lms.app.test_request_context(f"/librarian/borrows?{query_string}"):
+                self.assertIsNone(lms.requested_cursor("after"))
+                self.assertIsNone(lms.requested_cursor("before"))
+        cursor = str(self.ROWS[0]["_id"])
+        with lms.app.test_request_context(f"/librarian/borrows?after={cursor}"):
+            self.assertEqual(lms.requested_cursor("after"), cursor)
+
+class LRUCacheTest(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = lms.LRUCache(maxsize=2, ttl=60)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a", lambda: None), 1) # "a" is now the most recently used
+        cache.put("c", 3)
+        self.assertIsNone(cache.get("b", lambda: None)) # Evicted (a None load is not cached)
+        self.assertEqual((cache.get("a", lambda: None), cache.get("c", lambda: None)), (1, 3))
+        self.assertEqual(cache.stats(), dict(hits=3, misses=1, size=2))
+
+    def test_invalidation_bumps_the_generation(self):
+        cache = lms.LRUCache(maxsize=2, ttl=60)
+        generation = cache.generation()
+        cache.put("a", 1)
+        cache.invalidate("a")
+        self.assertEqual(cache.generation(), generation + 1)
+        cache.clear()
+        self.assertEqual(cache.generation(), generation + 2)
+        self.assertEqual(cache.stats()["size"], 0)
+
+    def test_value_loaded_before_an_invalidation_is_not_cached(self):
+        cache = lms.LRUCache(maxsize=2, ttl=60)
+
+        def stale_loader():
+            cache.invalidate("a") # The profile is updated while the old one is being read
+            return "old"
+
+        self.assertEqual(cache.get("a", stale_loader), "old") # Returned to this caller, but not kept
+        self.assertEqual(cache.get("a", lambda: "new"), "new")
+        self.assertEqual(cache.get("a", lambda: "reloaded"), "new")
+
+        generation = cache.generation()
+        cache.invalidate("b")
+        cache.put("b", "old", generation)
+        self.assertEqual(cache.get("b", lambda: "new"), "new")
+
+class StaticAssetsTest(unittest.TestCase):
+    def test_rewrite_css_urls(self):
+        manifest = {"img/logo.png": "img/logo.0123456789ab.png", "fonts/a.woff2": "fonts/a.ba9876543210.woff2"}
+        css = ("a{background:url(../img/logo.png)} b{background:url( '/img/logo.png?v=1#x' )} "
+            "@font-face{src:url(\"../fonts/a.woff2\")} c{background:url(data:image/png;base64,AAAA)} "
+            "d{background:url(https://cdn.example.com/x.png)} e{background:url(../img/missing.png)}")
+        self.assertEqual(lms.rewrite_css_urls(css, "css/site.css", manifest),
+            "a{background:url(../img/logo.0123456789ab.png)} b{background:url('../img/logo.0123456789ab.png?v=1#x')} "
+            "@font-face{src:url(\"../fonts/a.ba9876543210.woff2\")} c{background:url(data:image/png;base64,AAAA)} "
+            "d{background:url(https://cdn.example.com/x.png)} e{background:url(../img/missing.png)}")
+
+    def test_build_assets(self):
+        self.addCleanup(setattr, lms.app, "static_folder", lms.app.static_folder)
+        with tempfile.TemporaryDirectory() as static_folder:
+            for relpath, content in (("img/logo.png", b"png"), ("css/site.css", b"a{background:url(../img/logo.png)}")):
+                os.makedirs(os.path.join(static_folder, os.path.dirname(relpath)), exist_ok=True)
+                with open(os.path.join(static_folder, relpath), "wb") as fhand:
+                    fhand.write(content)
+            lms.app.static_folder = static_folder
+            manifest = lms.build_assets()
+            self.assertEqual(lms.build_assets(), manifest) # Rebuilt from scratch, ignoring the previous dist/
+
+            dist = os.path.join(static_folder, lms.ASSETS_DIR)
+            self.assertEqual(sorted(manifest), ["css/site.css", "img/logo.png"])
+            with open(os.path.join(dist, "manifest.json")) as fhand:
+                self.assertEqual(json.load(fhand), manifest)
+            with open(os.path.join(dist, manifest["css/site.css"]), "rb") as fhand:
+                css = fhand.read()
+            self.assertEqual(css, f"a{{background:url(../{manifest['img/logo.png']})}}".encode())
+            with open(os.path.join(dist, manifest["css/site.css"] + ".gz"), "rb") as fhand:
+                self.assertEqual(gzip.decompress(fhand.read()), css)
+
+        lms.app.static_folder = os.path.join(static_folder, "missing")
+        self.assertEqual(lms.build_assets(), dict())
+
+    def compress(self, response, accept_encoding="gzip, deflate"):
+        with lms.app.test_request_context("/", headers={"Accept-Encoding": accept_encoding}):
+            return lms.compress_response(response)
+
+    def test_compress_response(self):
+        body = "<p>catalog</p>" * 200
+        response = self.compress(lms.app.response_class(body, mimetype="text/html"))
+        self.assertEqual(response.content_encoding, "gzip")
+        self.assertIn("Accept-Encoding", response.vary)
+        self.assertEqual(gzip.decompress(response.get_data()).decode(), body)
+
+        self.assertIsNone(self.compress(lms.app.response_class(body, mimetype="text/html"), "br").content_encoding)
+        self.assertIsNone(self.compress(lms.app.response_class("<p>tiny</p>", mimetype="text/html")).content_encoding)
+        self.assertIsNone(self.compress(lms.app.response_class(body, mimetype="image/png")).content_encoding)
+
+    def test_compress_streamed_and_passthrough_responses(self):
+        # A streamed page is compressed chunk by chunk, with no Content-Length; a file sent as is is left alone
+        chunks = ["<p>catalog</p>" * 100, "<p>more</p>" * 100]
+        response = self.compress(lms.app.response_class(iter(chunks), mimetype="text/html"))
+        self.assertEqual(response.content_encoding, "gzip")
+        self.assertNotIn("Content-Length", response.headers)
+        compressed = list(response.response)
+        self.assertGreater(len(compressed), 2)
+        self.assertEqual(gzip.decompress(b"".join(compressed)).decode(), "".join(chunks))
+
+        response = lms.app.response_class(iter([b"<p>catalog</p>" * 200]), mimetype="text/html", direct_passthrough=True)
+        self.assertIsNone(self.compress(response).content_encoding)
+
+@requires_mongod
+class ReservationsFilterTest(unittest.TestCase):
+    """The nightly job's watermark window (needs a local mongod)."""
+
+    def setUp(self):
+        lms.db.client.drop_database(lms.db.name)
+        cwd = os.getcwd()
+        os.chdir(tempfile.mkdtemp()) # The job appends to a log file in the working directory
+        self.addCleanup(os.chdir, cwd)
+
+    def reserve(self, checkin):
+        book_id = lms.books.insert_one(dict(title=generate_random_string(), book_cover_url=generate_random_string(), available=True)).inserted_id
+        return lms.bookings.insert_one(dict(book_id=book_id, patron_id=ObjectId(), patron_name="patron", type="reserve",
+            checkin_date=checkin, checkout_date=checkin + timedelta(days=7))).inserted_id
+
+    def run_job(self):
+        lms._reservations_filter_()
+        return lms.jobs.find_one(dict(_id="reservations_filter"))["last_run"]
+
+    def test_rerun_same_day_is_a_no_op(self):
+        today = lms.to_booking_date(datetime.today())
+        due, later = self.reserve(today), self.reserve(today + timedelta(days=1))
+        self.assertEqual(self.run_job()["promoted"], 1)
+        run = self.run_job()
+        self.assertEqual((run["promoted"], run["books_held"], run["window_start"], run["window_end"]), (0, 0, today, today))
+        self.assertEqual([lms.bookings.find_one(dict(_id=b))["type"] for b in (due, later)], ["borrow", "reserve"])
+
+    def test_missed_days_are_caught_up(self):
+        today = lms.to_booking_date(datetime.today())
+        watermark = today - timedelta(days=3) # Last successful run three days ago
+        lms.jobs.insert_one(dict(_id="reservations_filter", watermark=watermark))
+        before, missed, due = self.reserve(today - timedelta(days=5)), self.reserve(today - timedelta(days=2)), self.reserve(today)
+        run = self.run_job()
+        self.assertEqual((run["promoted"], run["books_held"], run["window_start"], run["window_end"]), (2, 2, watermark, today))
+        self.assertEqual([lms.bookings.find_one(dict(_id=b))["type"] for b in (before, missed, due)], ["reserve", "borrow", "borrow"])
+        self.assertEqual(lms.jobs.find_one(dict(_id="reservations_filter"))["watermark"], today)
+
+    @classmethod
+    def tearDownClass(cls):
+        lms.db.client.drop_database(lms.db.name)
+
+class BookingDatesTest(unittest.TestCase):
+    """Native and legacy '%Y-%m-%d' booking dates, and the migration between them."""
+
+    def test_booking_date_filter(self):
+        at = datetime(2030, 1, 2, 15, 30)
+        with mock.patch.object(lms, "BOOKING_DATE_STRINGS", True):
+            self.assertEqual(lms.booking_date_filter("checkin_date", gte=at, lt="2030-02-01"), {"$or": [
+                {"checkin_date": {"$gte": datetime(2030, 1, 2), "$lt": datetime(2030, 2, 1)}},
+                {"checkin_date": {"$gte": "2030-01-02", "$lt": "2030-02-01"}}]})
+        with mock.patch.object(lms, "BOOKING_DATE_STRINGS", False):
+            self.assertEqual(lms.booking_date_filter("checkin_date", gte=at), {"checkin_date": {"$gte": datetime(2030, 1, 2)}})
+
+    @requires_mongod
+    def test_migrate_booking_dates(self):
+        lms.db.client.drop_database(lms.db.name)
+        rows = [dict(checkin_date="2030-01-0%d" % n, checkout_date="2030-01-1%d" % n) for n in range(1, 6)]
+        rows += [dict(checkin_date=datetime(2030, 2, 1), checkout_date="2030-02-08"), dict(checkin_date=datetime(2030, 3, 1),
+            checkout_date=datetime(2030, 3, 8))]
+        ids = lms.bookings.insert_many(rows).inserted_ids
+        # A run interrupted after the third booking resumes from its checkpoint and sweeps up the ones before it
+        lms.migrations.insert_one(dict(_id="booking_dates", last_id=ids[2], converted=0))
+
+        self.assertEqual(lms.migrate_booking_dates(batch_size=2), 6)
+        for booking_id, row in zip(ids, rows):
+            booking = lms.bookings.find_one(dict(_id=booking_id))
+            self.assertEqual((booking["checkin_date"], booking["checkout_date"]),
+                (lms.to_booking_date(row["checkin_date"]), lms.to_booking_date(row["checkout_date"])))
+        self.assertEqual(lms.migrate_booking_dates(batch_size=2), 6) # Nothing left: the total converted is unchanged
+        self.assertIsNone(lms.migrations.find_one(dict(_id="booking_dates"))["last_id"])
+        lms.db.client.drop_database(lms.db.name)
+
 if __name__ == "__main__":
     unittest.main()